@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Benchmark the lgit versions on deterministic synthetic repositories.
+
+Each repository is generated from a seed at a given scale (number of
+files, depth and fan-out of the directories, file size distribution),
+then every version runs the same scenario in its own copy of it: init,
+add ., commit, a history of commits changing a part of the files
+(status, add ., commit), then status, log and ls-files.
+The timings are written as JSON and compared against a baseline.
+
+    ./benchmark.py --files 1000 10000 --output results.json
+    ./benchmark.py --files 1000 10000 --baseline results.json
+"""
+from argparse import ArgumentParser
+from os import environ, makedirs
+from os.path import abspath, dirname, join
+from shutil import copytree, rmtree
+from subprocess import run, DEVNULL, PIPE, STDOUT, TimeoutExpired
+from tempfile import mkdtemp
+from time import perf_counter
+from random import Random
+from statistics import median
+from json import dump, load
+from platform import python_version, platform
+from re import compile as compile_regex, MULTILINE
+import sys
+
+VERSIONS = ('lgit_1.0.py', 'lgit_2.0.py', 'lgit_3.0.py')
+# the files are text (lowercase words and lines): the first versions only
+# read text files
+TEXT_TABLE = bytes(b'abcdefghijklmnopqrstuvwxyz     \n'[byte % 32]
+                   for byte in range(256))
+OPERATIONS = ('init', 'add', 'commit', 'status_dirty', 'add_churn',
+              'commit_churn', 'status', 'log', 'ls-files')
+# the output of a failed command: the versions before 3.0 print their
+# errors and exit with status 0
+ERROR_OUTPUT = compile_regex(rb'^(?:fatal: |error: |Traceback )', MULTILINE)
+
+
+def parse_arguments():
+    """Parse the scale of the repositories and the benchmark options."""
+    parser = ArgumentParser(
+        description='Benchmark the lgit versions on synthetic repositories')
+    parser.add_argument('--lgit', nargs='+',
+                        default=[join(dirname(abspath(__file__)), version)
+                                 for version in VERSIONS],
+                        help='lgit scripts to benchmark')
+    parser.add_argument('--files', nargs='+', type=int, default=[1000],
+                        help='number of files of each repository')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='depth of the directory tree')
+    parser.add_argument('--fanout', type=int, default=8,
+                        help='sub-directories of each directory')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='median file size in bytes (log-normal)')
+    parser.add_argument('--max-size', type=int, default=1 << 20,
+                        help='maximum file size in bytes')
+    parser.add_argument('--commits', type=int, default=5,
+                        help='number of commits of the history')
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help='fraction of the files changed by each commit')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each scenario (the median is kept)')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds before a command is abandoned')
+    parser.add_argument('--output', help='write the results to a JSON file')
+    parser.add_argument('--baseline',
+                        help='compare the results with a JSON file')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='slowdown reported as a regression')
+    return parser.parse_args()
+
+
+def get_directories(depth, fanout):
+    """Get the directories of a tree of the given depth and fan-out."""
+    directories, level = [''], ['']
+    for _ in range(depth):
+        level = [join(parent, 'd%d' % child)
+                 for parent in level for child in range(fanout)]
+        directories += level
+    return directories
+
+
+def get_file_size(rng, args):
+    """Draw a file size from a log-normal distribution."""
+    return min(args.max_size,
+               int(rng.lognormvariate(0, 1) * args.size))
+
+
+def get_random_text(rng, size):
+    return rng.randbytes(size).translate(TEXT_TABLE)
+
+
+def write_random_file(rng, path, size):
+    with open(path, 'wb') as file:
+        file.write(get_random_text(rng, size))
+
+
+def generate_repository(path, count, args):
+    """
+    Generate the working directory of a repository of count files.
+    Return the relative paths of the files.
+    """
+    rng = Random('%d:%d' % (args.seed, count))
+    directories = get_directories(args.depth, args.fanout)
+    for directory in directories[1:]:
+        makedirs(join(path, directory))
+    files = []
+    for number in range(count):
+        name = join(rng.choice(directories), 'f%d.dat' % number)
+        write_random_file(rng, join(path, name), get_file_size(rng, args))
+        files.append(name)
+    return files
+
+
+def change_files(path, files, round, args):
+    """
+    Change a part of the files (and create a few new ones) in the same
+    way for every version.
+    """
+    rng = Random('%d:%d:%d' % (args.seed, len(files), round))
+    changed = max(1, int(len(files) * args.churn))
+    for name in rng.sample(files, min(changed, len(files))):
+        with open(join(path, name), 'ab') as file:
+            file.write(get_random_text(rng, 64))
+    for number in range(max(1, changed // 10)):
+        name = 'new_%d_%d.dat' % (round, number)
+        write_random_file(rng, join(path, name), get_file_size(rng, args))
+        files.append(name)
+
+
+def run_lgit(lgit, path, arguments, timeout):
+    """
+    Run a lgit command in path, return its wall time in seconds or None
+    if it failed (an exit status other than 0 or an error in its output).
+    """
+    env = dict(environ, LOGNAME='bench', LGIT_PAGER='cat')
+    start = perf_counter()
+    result = run([sys.executable, lgit] + arguments, cwd=path, env=env,
+                 stdin=DEVNULL, stdout=PIPE, stderr=STDOUT,
+                 timeout=timeout)
+    elapsed = perf_counter() - start
+    if result.returncode or ERROR_OUTPUT.search(result.stdout):
+        return None
+    return elapsed
+
+
+def run_scenario(lgit, template, files, args):
+    """
+    Run the scenario in a copy of the generated repository.
+    Return the time of each operation (the median over the history for
+    the operations repeated for each commit), None if it failed or once
+    a command timed out.
+    """
+    work = mkdtemp(prefix='lgit_bench_')
+    path = join(work, 'repo')
+    copytree(template, path)
+    files = list(files)
+    times, history = {}, {'status_dirty': [], 'add_churn': [],
+                          'commit_churn': []}
+    try:
+        times['init'] = run_lgit(lgit, path, ['init'], args.timeout)
+        run_lgit(lgit, path, ['config', '--author', 'bench'], args.timeout)
+        times['add'] = run_lgit(lgit, path, ['add', '.'], args.timeout)
+        times['commit'] = run_lgit(lgit, path, ['commit', '-m', 'initial'],
+                                   args.timeout)
+        for round in range(1, args.commits):
+            change_files(path, files, round, args)
+            history['status_dirty'].append(
+                run_lgit(lgit, path, ['status'], args.timeout))
+            history['add_churn'].append(
+                run_lgit(lgit, path, ['add', '.'], args.timeout))
+            history['commit_churn'].append(run_lgit(
+                lgit, path, ['commit', '-m', 'round %d' % round],
+                args.timeout))
+        for operation, values in history.items():
+            values = [value for value in values if value is not None]
+            if values:
+                times[operation] = median(values)
+        for operation in ('status', 'log', 'ls-files'):
+            times[operation] = run_lgit(lgit, path, [operation],
+                                        args.timeout)
+    except TimeoutExpired:
+        pass
+    finally:
+        rmtree(work, ignore_errors=True)
+    return {operation: times.get(operation) for operation in OPERATIONS}
+
+
+def get_median_times(runs):
+    """Merge the times of several runs of a scenario (median)."""
+    merged = {}
+    for operation in OPERATIONS:
+        values = [times[operation] for times in runs
+                  if times[operation] is not None]
+        merged[operation] = median(values) if values else None
+    return merged
+
+
+def run_benchmark(args):
+    """Run the scenario of every version at every scale."""
+    results = {}
+    for count in args.files:
+        template = mkdtemp(prefix='lgit_bench_template_')
+        try:
+            files = generate_repository(template, count, args)
+            for lgit in args.lgit:
+                runs = [run_scenario(lgit, template, files, args)
+                        for _ in range(args.repeat)]
+                results.setdefault(lgit.rsplit('/', 1)[-1], {})[
+                    str(count)] = get_median_times(runs)
+                print_times(lgit, count, results)
+        finally:
+            rmtree(template, ignore_errors=True)
+    return results
+
+
+def format_time(value):
+    return '{:9.3f}s'.format(value) if value is not None else '       n/a'
+
+
+def print_times(lgit, count, results):
+    times = results[lgit.rsplit('/', 1)[-1]][str(count)]
+    print('{} ({} files)'.format(lgit.rsplit('/', 1)[-1], count))
+    for operation in OPERATIONS:
+        print('  {:14}{}'.format(operation, format_time(times[operation])))
+    sys.stdout.flush()
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Print the ratio of each time to the baseline.
+    Return the number of regressions (slower by more than threshold, or
+    failed while it succeeded in the baseline).
+    """
+    regressions = 0
+    for version, scales in sorted(results.items()):
+        for count, times in sorted(scales.items(), key=lambda item:
+                                   int(item[0])):
+            old_times = baseline.get(version, {}).get(count)
+            if not old_times:
+                continue
+            print('{} ({} files) against the baseline'.format(version,
+                                                              count))
+            for operation in OPERATIONS:
+                new, old = times.get(operation), old_times.get(operation)
+                if new is None and old is not None:
+                    regressions += 1
+                    print('  {:14}{}{}  FAILED'.format(
+                        operation, format_time(old), format_time(new)))
+                    continue
+                if new is None or not old:
+                    continue
+                ratio = new / old
+                regression = ratio > 1 + threshold
+                regressions += regression
+                print('  {:14}{}{}  x{:.2f}{}'.format(
+                    operation, format_time(old), format_time(new), ratio,
+                    '  REGRESSION' if regression else ''))
+    return regressions
+
+
+def main():
+    args = parse_arguments()
+    args.lgit = [abspath(lgit) for lgit in args.lgit]
+    results = run_benchmark(args)
+    report = {
+        'python': python_version(),
+        'platform': platform(),
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('lgit', 'output', 'baseline')},
+        'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            dump(report, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = load(file)['results']
+        if compare_results(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
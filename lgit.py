@@ -0,0 +1,4288 @@
+#!/usr/bin/env python3
+from argparse import ArgumentParser, ArgumentTypeError, REMAINDER
+from os import (getcwd, mkdir, environ, scandir, unlink, listdir, stat, sep,
+                replace, cpu_count, fstat, rmdir, close, read, getpid,
+                fork, setsid, waitpid, dup2, devnull, fsencode, fsdecode,
+                _exit, chdir, fsync, makedirs, O_WRONLY, O_CREAT, O_EXCL)
+from os import open as open_descriptor
+try:
+    from os import copy_file_range
+except ImportError:
+    # Linux only: the objects are copied in user space elsewhere
+    copy_file_range = None
+from os.path import (abspath, exists, isdir, isfile, dirname, relpath,
+                     getsize, join)
+from hashlib import sha1
+from datetime import datetime
+from time import time, time_ns, sleep, perf_counter_ns
+from collections import namedtuple
+from struct import Struct
+from stat import S_ISREG
+from math import isqrt
+from mmap import mmap, ACCESS_READ
+from zlib import (compressobj, decompressobj, compress, decompress,
+                  error as zlib_error)
+from itertools import chain, islice, accumulate, starmap
+from functools import partial
+from gc import disable as disable_gc, enable as enable_gc, isenabled
+from bisect import bisect_left
+from heapq import merge
+from operator import itemgetter
+from json import dumps, loads
+import sys
+from io import StringIO
+from contextlib import redirect_stdout, redirect_stderr, contextmanager
+from fcntl import ioctl
+from signal import signal, SIGTERM
+from re import compile as compile_regex, escape
+# tempfile, concurrent.futures, socket, selectors, subprocess and ctypes
+# are imported by the functions using them: most commands never need
+# them, and they would double the startup time of every command
+
+
+INDEX_SIGNATURE = b'LGIX'
+INDEX_VERSION = 2
+# signature, version, number of entries, size of the path table
+INDEX_HEADER = Struct('>4sIII')
+# ctime, mtime, inode, size, 3 SHA1s: the fields of an IndexEntry
+INDEX_RECORD = Struct('>qqQQ20s20s20s')
+# offset of a path in the path table (and of the next one)
+INDEX_OFFSET = Struct('>I')
+INDEX_OFFSETS = Struct('>II')
+# record of version 1: the path offset and length follow the fields
+INDEX_RECORD_V1 = Struct('>qqQQ20s20s20sII')
+# signature and size of an extension
+INDEX_EXTENSION = Struct('>4sI')
+COMMIT_GRAPH_SIGNATURE = b'LCGR'
+COMMIT_GRAPH_VERSION = 1
+# signature, version, number of commits, size of the author table
+COMMIT_GRAPH_HEADER = Struct('>4sIII')
+# commit ID, parent position (-1 if none), timestamp, author offset/length
+COMMIT_GRAPH_RECORD = Struct('>24siqIH')
+# commits appended to commit-graph.log before they are merged in the graph
+COMMIT_GRAPH_BATCH = 1 << 10
+FSMONITOR_EXTENSION = b'FSMN'
+UNTRACKED_EXTENSION = b'UNTR'
+CACHE_TREE_EXTENSION = b'TREE'
+# number of files under the directory, raw SHA1 of its tree
+CACHE_TREE_RECORD = Struct('>I20s')
+NULL_SHA = bytes(20)
+CHUNK_SIZE = 1 << 16
+OBJECT_TYPES = ('blob', 'chunk', 'chunked', 'tree')
+OBJECT_HEADER = compile_regex(
+    rb'(' + '|'.join(OBJECT_TYPES).encode() + rb') (\d+)\0')
+OBJECT_ID = compile_regex(rb'[0-9a-f]{40}')
+OBJECT_IDS_SIGNATURE = b'LOID'
+OBJECT_IDS_VERSION = 1
+# signature, version, number of IDs, size of the Bloom filter in bytes
+OBJECT_IDS_HEADER = Struct('>4sIII')
+# the bits of an ID in the Bloom filter: words of its SHA1 (random)
+BLOOM_POSITIONS = Struct('>5I')
+BLOOM_BITS_PER_ID = 10
+# IDs appended to object-ids.log before they are merged into object-ids
+OBJECT_IDS_BATCH = 1 << 14
+PACK_SIGNATURE = b'LPAK'
+PACK_INDEX_SIGNATURE = b'LIDX'
+PACK_VERSION = 1
+# signature, version, number of objects
+PACK_HEADER = Struct('>4sII')
+PACK_FANOUT = Struct('>256I')
+PACK_OFFSET = Struct('>Q')
+# delta flag, object type, size of the content, size of the stored data
+PACK_ENTRY = Struct('>BBQQ')
+DELTA_COPY = Struct('>II')
+DELTA_INSERT = Struct('>I')
+DELTA_BLOCK = 16
+DELTA_WINDOW = 10
+DELTA_DEPTH = 10
+DELTA_LIMIT = 1 << 23
+DELTA_WINDOW_MEMORY = 1 << 26
+# files of at least LGIT_CHUNK_THRESHOLD bytes are stored as chunked blobs
+# (0 to disable)
+CHUNK_THRESHOLD = int(environ.get('LGIT_CHUNK_THRESHOLD', 1 << 25))
+CDC_MIN = 1 << 18
+CDC_MAX = 1 << 22
+# a chunk boundary ends a window of CDC_WINDOW bytes whose rolling hash
+# is CDC_TARGET (19 bits: about one position in 500 000)
+CDC_WINDOW = 64
+CDC_BLOCK = 1 << 18
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+FSMONITOR_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE)
+# watch descriptor, mask, cookie, length of the name
+INOTIFY_EVENT = Struct('iIII')
+FSMONITOR_BUFFER = 1 << 16
+FSMONITOR_TIMEOUT = 5
+DAEMON_START_TRIES = 200
+DIFF_CONTEXT = 3
+DIFF_BLOCK = 1 << 16
+DIFF_BINARY_CHECK = 8000
+# minimum edit cost searched for a middle snake before giving up (xdiff)
+DIFF_MAX_COST_MIN = 256
+# diagonals searched for the middle snakes of a whole file: past it, each
+# region left is shown as one change
+DIFF_MAX_WORK = 1 << 21
+# ioctl sharing the blocks of a file with another one (Btrfs, XFS)
+FICLONE = 0x40049409
+# seconds to wait for the index lock held by another process (0: fail fast)
+LOCK_TIMEOUT = float(environ.get('LGIT_LOCK_TIMEOUT', 5))
+LOCK_RETRY = 0.01
+# unreachable objects younger than LGIT_GC_GRACE seconds are kept by gc
+GC_GRACE = float(environ.get('LGIT_GC_GRACE', 14 * 24 * 3600))
+CDC_TABLES = tuple(
+    bytes(sha1(bytes([plane, byte])).digest()[0] & mask for byte in range(256))
+    for plane, mask in enumerate((0xff, 0xff, 0x07)))
+# not zero: the windows of a repeated byte (or pair of bytes) hash to zero
+CDC_TARGET = (0x5a, 0xc3, 0x05)
+# the SHA1s of an index entry are raw 20-byte digests (NULL_SHA if unset),
+# as they are stored in the index file
+IndexEntry = namedtuple(
+    'IndexEntry',
+    ['ctime', 'mtime', 'ino', 'size', 'sha', 'staged_sha', 'commit_sha'])
+# build an IndexEntry from a record without a Python-level call
+make_index_entry = partial(tuple.__new__, IndexEntry)
+# result of Repository.status(): HEAD (None before the first commit) and
+# the sorted paths of each section
+Status = namedtuple('Status', ['head', 'staged', 'unstaged', 'untracked'])
+# item of Repository.log(): the message is only read for the yielded commits
+Commit = namedtuple('Commit', ['id', 'parent', 'author', 'date', 'message'])
+
+
+class LgitError(Exception):
+    """A fatal error of a lgit command, printed by the command line."""
+
+
+def parse_arguments(argv=None):
+    """
+    Parse command line strings into Python objects.
+
+    @return: (namespace) An object to take the attributes.
+    """
+    parser = ArgumentParser(
+        usage='./lgit.py <command> [<args>]',
+        description='A lightweight version of git')
+    sub_parsers = parser.add_subparsers(
+        dest='command',
+        metavar='command',
+        help='lgit command')
+    parser.add_argument('--trace', metavar='FILE',
+                        default=environ.get('LGIT_TRACE'),
+                        help='write the timings of the command to FILE '
+                             '(or $LGIT_TRACE)')
+    parser.add_argument('--trace-format', choices=['json', 'chrome'],
+                        default=environ.get('LGIT_TRACE_FORMAT', 'json'),
+                        help='format of the trace (or $LGIT_TRACE_FORMAT)')
+    # lgit init
+    init_parser = sub_parsers.add_parser('init')
+    # lgit add files
+    add_parser = sub_parsers.add_parser('add')
+    add_parser.add_argument('files', nargs='+')
+    add_parser.add_argument('-j', '--jobs', type=int, default=cpu_count(),
+                            help='number of worker processes')
+    # lgit rm files
+    remove_parser = sub_parsers.add_parser('rm')
+    remove_parser.add_argument('files', nargs='+')
+    # lgit config --author name
+    config_parser = sub_parsers.add_parser('config')
+    config_parser.add_argument('--author', required=True)
+    # lgit commit -m message
+    commit_parser = sub_parsers.add_parser('commit')
+    commit_parser.add_argument('-m', dest='message', required=True)
+    # lgit status
+    status_parser = sub_parsers.add_parser('status')
+    # lgit log
+    log_parser = sub_parsers.add_parser('log')
+    log_parser.add_argument('-n', '--max-count', dest='count', type=int,
+                            help='show at most this number of commits')
+    log_parser.add_argument('--since', type=parse_log_date,
+                            help='show the commits after a date')
+    log_parser.add_argument('--until', type=parse_log_date,
+                            help='show the commits before a date')
+    log_parser.add_argument('--author',
+                            help='show the commits whose author matches')
+    # lgit ls-file
+    list_files_parser = sub_parsers.add_parser('ls-files')
+    # lgit diff [--cached] [<commit> [<commit>]]
+    diff_parser = sub_parsers.add_parser('diff')
+    diff_parser.add_argument('--cached', '--staged', action='store_true',
+                             help='compare the index with a commit')
+    diff_parser.add_argument('commits', nargs='*', metavar='commit')
+    # lgit checkout <commit> | [<commit>] -- <paths>
+    checkout_parser = sub_parsers.add_parser('checkout')
+    # REMAINDER keeps '--', which separates the commit from the paths
+    checkout_parser.add_argument('arguments', nargs=REMAINDER,
+                                 metavar='[<commit>] [-- <paths>]')
+    # lgit repack
+    repack_parser = sub_parsers.add_parser('repack')
+    # lgit gc [--grace seconds]
+    gc_parser = sub_parsers.add_parser('gc')
+    gc_parser.add_argument('--grace', type=float, default=GC_GRACE,
+                           help='keep the unreachable objects younger than '
+                                'this number of seconds')
+    # lgit fsmonitor start|stop|status
+    fsmonitor_parser = sub_parsers.add_parser('fsmonitor')
+    fsmonitor_parser.add_argument('action',
+                                  choices=['start', 'stop', 'status'])
+    # lgit serve start|stop|status
+    serve_parser = sub_parsers.add_parser('serve')
+    serve_parser.add_argument('action', choices=['start', 'stop', 'status'])
+    return parser.parse_args(argv)
+
+
+def get_lgit_directory(path=None):
+    """
+    Get the closest directory (from path or the current directory) that has
+    a .lgit directory in it.
+    """
+    path = abspath(path or getcwd())
+    while path != '/':
+        if isdir(path + '/.lgit'):
+            return path
+        path = dirname(path)
+    return None
+
+
+class Repository:
+    """
+    A lgit repository. The root directory is discovered once per
+    invocation and the paths derived from it, the loaded index and the
+    open pack files are cached for all commands.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lgit = root + '/.lgit'
+        self.objects = self.lgit + '/objects'
+        self.commits = self.lgit + '/commits'
+        self.snapshots = self.lgit + '/snapshots'
+        self.index_path = self.lgit + '/index'
+        self.index_lock_path = self.index_path + '.lock'
+        self.config = self.lgit + '/config'
+        self.head = self.lgit + '/HEAD'
+        self.commit_graph = self.lgit + '/commit-graph'
+        self.commit_graph_log = self.commit_graph + '.log'
+        self.object_ids_path = self.lgit + '/object-ids'
+        self.object_ids_log_path = self.lgit + '/object-ids.log'
+        self.index = None
+        self.index_extensions = None
+        self.index_stat = None
+        self.index_lock = None
+        self.cache_tree = None
+        self.index_changed = False
+        self.fsmonitor_queried = False
+        self.fsmonitor_token = None
+        self.fsmonitor_changes = None
+        self.mapped_index = None
+        self.packs = None
+        self.object_ids = None
+        self.ignore = None
+
+    def __reduce__(self):
+        # Worker processes only need the root, not the cached handles.
+        return Repository, (self.root,)
+
+    @classmethod
+    def discover(cls, path=None):
+        """
+        Return the closest repository (from path or the current directory),
+        or None if there is none.
+        """
+        root = get_lgit_directory(path)
+        return cls(root) if root else None
+
+    def add(self, paths, jobs=1):
+        """
+        Stage files (or all the files of directories, '.' for all), the
+        paths (or a single path) being relative to the root of the
+        repository. Return the index keys of the staged files.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        with releasing_index_lock(self):
+            return lgit_add(self, paths, jobs, self.root)
+
+    def remove(self, paths):
+        """
+        Remove files (paths, or a single path, relative to the root of the
+        repository) from the working directory and the index.
+        Return the paths not removed because they are directories.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        with releasing_index_lock(self):
+            return remove_files(self, paths, self.root)
+
+    def status(self):
+        """Return the Status of the index and the working directory."""
+        return get_status(self)
+
+    def set_author(self, author):
+        """Set the author of the commits (lgit config --author)."""
+        lgit_config(self, author)
+
+    def commit(self, message):
+        """Commit the staged changes, return the ID of the commit."""
+        with releasing_index_lock(self):
+            return lgit_commit(self, message)
+
+    def log(self, count=None, since=None, until=None, author=None):
+        """
+        Yield the Commits from HEAD, newest first: at most count, between
+        the POSIX timestamps since and until, with an author matching the
+        regular expression author.
+        """
+        return get_log(self, count, since, until, author)
+
+    def ls_files(self, prefix=''):
+        """Yield the tracked files under prefix (a path from the root)."""
+        return get_tracked_files(self, prefix)
+
+    def diff(self, commits=(), cached=False):
+        """Yield the unified diff of lgit diff [--cached] [commits]."""
+        return get_diff(self, commits, cached)
+
+    def checkout(self, commit=None, paths=None):
+        """
+        Check out a commit (HEAD, an ID or a unique prefix) if paths is
+        None, otherwise restore the files under paths (relative to the root
+        of the repository) from the index or the commit.
+        Return the paths written in the working directory.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        commit_id = resolve_commit(self, commit) if commit else None
+        if paths is None and commit_id is None:
+            raise LgitError('fatal: you must specify a commit or path(s)')
+        with releasing_index_lock(self):
+            if paths is not None:
+                return restore_files(self, paths, commit_id, self.root)
+            return switch_commit(self, commit_id)
+
+    def gc(self, grace=GC_GRACE):
+        """
+        Remove the unreachable objects older than grace seconds, return
+        their number.
+        """
+        return collect_garbage(self, grace)
+
+
+def print_repo_exist_error():
+    print('fatal: not a git repository (or any of the parent directories)')
+
+
+def create_dir(path):
+    """Create a directory."""
+    if not exists(path):
+        try:
+            mkdir(path)
+        except FileExistsError:
+            pass
+
+
+def create_file(path):
+    """Create a file."""
+    try:
+        with open(path, 'w+'):
+            pass
+    except PermissionError:
+        pass
+
+
+def write_lgit_file(repo, path, data):
+    """
+    Write a file of the repository in one buffered write: the data goes to
+    a temporary file in .lgit directory, then the file is moved to path so
+    it is never seen half-written (nor listed while being written).
+    """
+    from tempfile import mkstemp
+    descriptor, temp_path = mkstemp(dir=repo.lgit, prefix='tmp_')
+    try:
+        with open(descriptor, 'wb') as file:
+            file.write(data)
+        replace(temp_path, path)
+    except BaseException:
+        unlink(temp_path)
+        raise
+
+
+def write_logname_config(repo):
+    """Write LOGNAME to config files"""
+    try:
+        file = open(repo.config, 'w+')
+        file.write(environ['LOGNAME'] + '\n')
+        file.close()
+    except (PermissionError, FileNotFoundError):
+        pass
+
+
+def create_repo():
+    """Create the .lgit repository."""
+    dirs = ['.lgit',
+            '.lgit/objects',
+            '.lgit/commits',
+            '.lgit/snapshots']
+    files = ['.lgit/index',
+             '.lgit/config']
+    for dir in dirs:
+        create_dir(dir)
+    for file in files:
+        create_file(file)
+    write_logname_config(Repository(getcwd()))
+
+
+def lgit_init():
+    """Initialize version control in the current directory."""
+    if get_lgit_directory():
+        print('Git repository already initialized.')
+    else:
+        create_repo()
+
+
+def get_hex_digest(raw):
+    """Convert a raw 20-byte digest of the index to SHA1 (None if null)."""
+    return None if raw == NULL_SHA else raw.hex()
+
+
+def get_raw_digest(sha):
+    """Convert SHA1 to a raw 20-byte digest of the index."""
+    return bytes.fromhex(sha) if sha else NULL_SHA
+
+
+def parse_text_index(data):
+    """
+    Parse the index file written by the previous (text) format.
+    It is rewritten in the binary format by the next update.
+    """
+    index = {}
+    for line in data.decode('utf-8', 'surrogateescape').splitlines():
+        if not line.strip():
+            continue
+        fields = line[138:].split(' ', 4)
+        if len(fields) == 5:
+            stat_data = tuple(int(field) for field in fields[:4])
+        else:
+            stat_data = (0, 0, 0, 0)
+        shas = [get_raw_digest(line[start:start + 40].strip())
+                for start in (15, 56, 97)]
+        index[line.split()[-1]] = IndexEntry(*stat_data, *shas)
+    return index
+
+
+def parse_binary_index_v1(data, count, path_size):
+    """
+    Parse the binary index file written by the first binary format (the
+    path offset and length in each record), rewritten by the next update.
+    """
+    table = INDEX_HEADER.size + count * INDEX_RECORD_V1.size
+    index = {}
+    for record in INDEX_RECORD_V1.iter_unpack(data[INDEX_HEADER.size:table]):
+        start = table + record[7]
+        path = bytes(data[start:start + record[8]])
+        index[path.decode('utf-8', 'surrogateescape')] = IndexEntry._make(
+            record[:7])
+    return index, parse_index_extensions(data, table + path_size)
+
+
+def parse_index_extensions(data, start):
+    """
+    Parse the extensions written between the path table and the checksum
+    of the index file (signature, size and data of each extension).
+    """
+    extensions = {}
+    while start + INDEX_EXTENSION.size <= len(data) - 20:
+        signature, size = INDEX_EXTENSION.unpack_from(data, start)
+        start += INDEX_EXTENSION.size
+        extensions[signature] = bytes(data[start:start + size])
+        start += size
+    return extensions
+
+
+@contextmanager
+def paused_gc():
+    """Disable the cyclic garbage collector while many objects are built."""
+    enabled = isenabled()
+    disable_gc()
+    try:
+        yield
+    finally:
+        if enabled:
+            enable_gc()
+
+
+def get_index_dict(repo):
+    """
+    Return the index dictionary (path -> IndexEntry) of the repository,
+    parsed once from the memory-mapped index file and cached.
+    """
+    if repo.index is None:
+        mapped = get_mapped_index(repo)
+        # the stat data of the mapped file: a later write is detected
+        repo.index_stat = mapped.stat
+        repo.index = mapped.get_dict()
+        if repo.index_extensions is None:
+            repo.index_extensions = dict(mapped.extensions)
+            repo.cache_tree = None
+    return repo.index
+
+
+def get_index_extensions(repo):
+    """
+    Return the extensions of the index (signature -> data), read from
+    the memory-mapped index without parsing its entries and cached.
+    """
+    if repo.index_extensions is None:
+        repo.index_extensions = dict(get_mapped_index(repo).extensions)
+        repo.cache_tree = None
+    return repo.index_extensions
+
+
+def get_cache_tree(repo):
+    """
+    Return the cache tree of the index (cached): a dictionary mapping the
+    directories ('' for the root) whose tree object is up to date to
+    (number of files under the directory, SHA1 of its tree).
+    """
+    extensions = get_index_extensions(repo)
+    if repo.cache_tree is None:
+        repo.cache_tree = parse_cache_tree(
+            extensions.get(CACHE_TREE_EXTENSION, b''))
+    return repo.cache_tree
+
+
+def parse_cache_tree(data):
+    """Parse the cache tree extension (path, NUL byte, record, ...)."""
+    cache, start = {}, 0
+    while start < len(data):
+        end = data.index(b'\0', start)
+        count, sha = CACHE_TREE_RECORD.unpack_from(data, end + 1)
+        cache[data[start:end].decode('utf-8', 'surrogateescape')] = (
+            count, sha.hex())
+        start = end + 1 + CACHE_TREE_RECORD.size
+    return cache
+
+
+def pack_cache_tree(cache):
+    """Pack the cache tree to the data of the index extension."""
+    return b''.join(
+        path.encode('utf-8', 'surrogateescape') + b'\0' +
+        CACHE_TREE_RECORD.pack(count, bytes.fromhex(sha))
+        for path, (count, sha) in sorted(cache.items()))
+
+
+def invalidate_cache_tree(repo, key):
+    """Remove the ancestor directories of a path from the cache tree."""
+    cache = get_cache_tree(repo)
+    parts = key.split('/')
+    for position in range(len(parts)):
+        cache.pop('/'.join(parts[:position]), None)
+
+
+def get_mapped_index(repo):
+    """Return the memory-mapped index of the repository (cached)."""
+    if repo.mapped_index is None:
+        repo.mapped_index = MappedIndex(repo)
+    return repo.mapped_index
+
+
+class MappedIndex:
+    """
+    A read-only view of the index file, memory-mapped: an entry is looked
+    up by binary search over the records (sorted by path) without parsing
+    the others, and the whole index is only parsed by get_dict. The files
+    of the previous formats are parsed at once instead.
+    """
+
+    def __init__(self, repo):
+        self.map, self.entries, self.extensions = None, {}, {}
+        self.stat, self.count = (0, 0, 0, 0), 0
+        try:
+            with open(repo.index_path, 'rb') as file:
+                info = fstat(file.fileno())
+                self.stat = (info.st_ctime_ns, info.st_mtime_ns,
+                             info.st_ino, info.st_size)
+                if info.st_size:
+                    self.map = mmap(file.fileno(), 0, access=ACCESS_READ)
+        except (PermissionError, FileNotFoundError):
+            return
+        if self.map is None:
+            return
+        if self.map[:4] != INDEX_SIGNATURE:
+            self.entries = parse_text_index(self.map[:])
+            self.map, self.count = None, len(self.entries)
+            return
+        _, version, self.count, path_size = INDEX_HEADER.unpack_from(
+            self.map)
+        if version == 1:
+            self.check()
+            self.entries, self.extensions = parse_binary_index_v1(
+                memoryview(self.map), self.count, path_size)
+            self.map = None
+            return
+        if version != INDEX_VERSION:
+            raise LgitError('fatal: index file corrupt')
+        self.offsets = INDEX_HEADER.size + self.count * INDEX_RECORD.size
+        self.table = self.offsets + (self.count + 1) * INDEX_OFFSET.size
+        self.extensions = parse_index_extensions(
+            self.map, self.table + path_size)
+
+    def check(self):
+        """Check the SHA1 checksum at the end of the index file."""
+        if sha1(memoryview(self.map)[:-20]).digest() != self.map[-20:]:
+            raise LgitError('fatal: index file corrupt')
+
+    def __len__(self):
+        return self.count
+
+    def get_path(self, position):
+        start, end = INDEX_OFFSETS.unpack_from(
+            self.map, self.offsets + position * INDEX_OFFSET.size)
+        # the path is followed by a NUL byte
+        return self.map[self.table + start:self.table + end - 1].decode(
+            'utf-8', 'surrogateescape')
+
+    def get_entry(self, position):
+        return IndexEntry._make(INDEX_RECORD.unpack_from(
+            self.map, INDEX_HEADER.size + position * INDEX_RECORD.size))
+
+    def bisect(self, path):
+        """Return the position of the first path not less than path."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_path(middle) < path:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, path):
+        """Return the IndexEntry of path, or None if it is not tracked."""
+        if self.map is None:
+            return self.entries.get(path)
+        position = self.bisect(path)
+        if position < self.count and self.get_path(position) == path:
+            return self.get_entry(position)
+        return None
+
+    def __contains__(self, path):
+        return self.find(path) is not None
+
+    def find_prefix(self, prefix):
+        """
+        Yield the tracked paths starting with prefix (a directory ending
+        with '/') and their IndexEntry, in sorted order.
+        """
+        if self.map is None:
+            for path in sorted(self.entries):
+                if path.startswith(prefix):
+                    yield path, self.entries[path]
+            return
+        # '0' follows '/': the paths under prefix are before prefix + '0'
+        end = self.bisect(prefix[:-1] + '0')
+        for position in range(self.bisect(prefix), end):
+            yield self.get_path(position), self.get_entry(position)
+
+    def get_paths(self):
+        """Return the tracked paths in sorted order."""
+        if self.map is None:
+            return sorted(self.entries)
+        start = self.table
+        end = start + INDEX_OFFSET.unpack_from(
+            self.map, self.table - INDEX_OFFSET.size)[0]
+        if start == end:
+            return []
+        return self.map[start:end - 1].decode(
+            'utf-8', 'surrogateescape').split('\0')
+
+    def get_records(self):
+        """Yield the records (IndexEntry fields) in sorted order."""
+        return INDEX_RECORD.iter_unpack(
+            self.map[INDEX_HEADER.size:self.offsets])
+
+    def iter_entries(self):
+        """Yield the IndexEntry of the tracked paths in sorted order."""
+        if self.map is None:
+            return map(self.entries.get, sorted(self.entries))
+        return map(make_index_entry, self.get_records())
+
+    def items(self):
+        """Yield the tracked paths and their IndexEntry in sorted order."""
+        return zip(self.get_paths(), self.iter_entries())
+
+    def get_dict(self):
+        """
+        Parse the whole index to a new index dictionary, checking the
+        checksum of the file first.
+        """
+        if self.map is None:
+            return dict(self.entries)
+        self.check()
+        # the collector would walk the new entries again and again
+        with paused_gc():
+            return dict(self.items())
+
+
+def get_index_mtime(repo):
+    """Get the modification time (nanoseconds) of the index file."""
+    try:
+        return stat(repo.index_path).st_mtime_ns
+    except (PermissionError, FileNotFoundError):
+        return 0
+
+
+def smudge_racy_entry(entry, racy_time):
+    """
+    Zero the stat data of an entry modified in the same timestamp tick as
+    the index write, so the next command re-hashes it instead of trusting
+    it.
+    """
+    if entry.mtime >= racy_time:
+        return entry._replace(ctime=0, mtime=0, ino=0, size=0)
+    return entry
+
+
+def lock_index(repo, timeout=0):
+    """
+    Take the index lock by creating index.lock exclusively, retrying for
+    timeout seconds while another process holds it.
+    Return True if the lock is taken.
+    """
+    deadline = time() + timeout
+    while repo.index_lock is None:
+        try:
+            repo.index_lock = open_descriptor(
+                repo.index_lock_path, O_WRONLY | O_CREAT | O_EXCL, 0o644)
+        except FileExistsError:
+            if time() >= deadline:
+                return False
+            sleep(LOCK_RETRY)
+    return True
+
+
+def acquire_index_lock(repo):
+    """
+    Take the index lock before reading the index to change it, so that
+    concurrent writers queue (up to LOCK_TIMEOUT seconds) instead of
+    overwriting each other. Fail if another process keeps holding it.
+    """
+    if not lock_index(repo, LOCK_TIMEOUT):
+        raise LgitError(
+            "fatal: Unable to create '" + repo.index_lock_path +
+            "': File exists.\n\nAnother lgit process seems to be running "
+            "in this repository.\nIf it crashed, remove the file manually "
+            "to continue.")
+    # the index and the object-ids file may have changed while unlocked
+    repo.index, repo.index_extensions = None, None
+    repo.mapped_index, repo.object_ids = None, None
+
+
+def unlock_index(repo):
+    """Release the index lock without writing the index."""
+    if repo.index_lock is not None:
+        close(repo.index_lock)
+        repo.index_lock = None
+        try:
+            unlink(repo.index_lock_path)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def releasing_index_lock(repo):
+    """
+    Release the index lock when a command leaves it held (an error after
+    the lock was taken), so that the other lgit processes can go on.
+    """
+    try:
+        yield
+    finally:
+        unlock_index(repo)
+
+
+def update_index_file(repo, index):
+    """
+    Rewrite the index file in the binary format:
+    - header (signature, version, number of entries, size of path table).
+    - fixed-width records sorted by path (stat data and 3 raw SHA1s).
+    - offsets of the paths in the path table, and its size.
+    - path table (each path followed by a NUL byte).
+    - extensions of the repository (signature, size and data of each),
+      the cache tree included.
+    - SHA1 checksum of everything above.
+    The new index is written to index.lock, flushed to disk and renamed
+    over the index, which also releases the lock. Without the lock held
+    (a refresh of the stat cache), the index is only written if the lock
+    is free and nobody changed the index since it was read.
+    """
+    if repo.index_lock is None:
+        try:
+            if not lock_index(repo):
+                return
+        except PermissionError:
+            return
+        if get_stat_data(repo.index_path) != repo.index_stat:
+            unlock_index(repo)
+            return
+    if repo.cache_tree is not None:
+        get_index_extensions(repo)[CACHE_TREE_EXTENSION] = pack_cache_tree(
+            repo.cache_tree)
+    paths = sorted(index)
+    entries = list(map(index.__getitem__, paths))
+    # the records and the paths are packed by C loops, not entry by entry
+    table = ('\0'.join(paths) + '\0' if paths else '').encode(
+        'utf-8', 'surrogateescape')
+    if len(table) == sum(map(len, paths)) + len(paths):
+        lengths = map(len, paths)
+    else:
+        lengths = (len(path.encode('utf-8', 'surrogateescape'))
+                   for path in paths)
+    offsets = list(accumulate(map((1).__add__, lengths), initial=0))
+    extensions = [INDEX_EXTENSION.pack(signature, len(data)) + data
+                  for signature, data in sorted(
+                      get_index_extensions(repo).items())]
+    data = b''.join([INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION,
+                                       len(paths), len(table)),
+                     b''.join(starmap(INDEX_RECORD.pack, entries)),
+                     Struct('>{}I'.format(len(offsets))).pack(*offsets),
+                     table] + extensions)
+    repo.index, repo.mapped_index = index, None
+    try:
+        with open(repo.index_lock, 'wb', closefd=False) as file:
+            file.write(data)
+            file.write(sha1(data).digest())
+            file.flush()
+            # the entries modified in the same tick as the index file are
+            # racy: smudged in place, which keeps the size of the file
+            racy_time = fstat(file.fileno()).st_mtime_ns
+            if entries and max(map(itemgetter(1), entries)) >= racy_time:
+                data = bytearray(data)
+                for position, entry in enumerate(entries):
+                    if entry.mtime >= racy_time:
+                        entry = smudge_racy_entry(entry, racy_time)
+                        index[paths[position]] = entry
+                        INDEX_RECORD.pack_into(
+                            data, INDEX_HEADER.size +
+                            position * INDEX_RECORD.size, *entry)
+                file.seek(0)
+                file.write(data)
+                file.write(sha1(data).digest())
+                file.flush()
+            fsync(file.fileno())
+        replace(repo.index_lock_path, repo.index_path)
+    except BaseException:
+        unlock_index(repo)
+        raise
+    # index.lock is gone with the rename: another process may already
+    # hold a new one, so only the descriptor is closed
+    info = fstat(repo.index_lock)
+    repo.index_stat = (info.st_ctime_ns, info.st_mtime_ns, info.st_ino,
+                       info.st_size)
+    close(repo.index_lock)
+    repo.index_lock = None
+
+
+def translate_ignore_pattern(pattern):
+    """
+    Translate a pattern of .lgitignore to a regular expression:
+    '*' and '?' do not match '/', '**' matches any number of directories.
+    """
+    regex, position = '', 0
+    while position < len(pattern):
+        if pattern.startswith('**/', position):
+            regex, position = regex + '(?:.*/)?', position + 3
+            continue
+        if pattern.startswith('**', position):
+            regex, position = regex + '.*', position + 2
+            continue
+        char = pattern[position]
+        end = pattern.find(']', position + 2) if char == '[' else -1
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif end != -1:
+            chars = pattern[position + 1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[' + chars + ']'
+            position = end
+        else:
+            regex += escape(char)
+        position += 1
+    return regex
+
+
+def compile_ignore_patterns(regexes):
+    """Compile regular expressions to one matcher (None if empty)."""
+    if not regexes:
+        return None
+    return compile_regex('(?:' + '|'.join(regexes) + r')\Z').match
+
+
+def get_ignore_matchers(repo):
+    """
+    Compile the patterns of .lgitignore (one per line, '#' for comments)
+    to two matchers of paths relative to the root: one for files and one
+    for directories (a pattern ending with '/' only matches directories).
+    A pattern without '/' matches a name at any depth.
+    The matchers are cached in the repository.
+    """
+    if repo.ignore is not None:
+        return repo.ignore
+    files, dirs = [], []
+    for line in (get_content(repo.root + '/.lgitignore') or '').splitlines():
+        pattern = line.strip()
+        if not pattern or pattern.startswith('#'):
+            continue
+        regex = translate_ignore_pattern(pattern.strip('/'))
+        if '/' not in pattern.rstrip('/'):
+            regex = '(?:.*/)?' + regex
+        dirs.append(regex)
+        if not pattern.endswith('/'):
+            files.append(regex)
+    repo.ignore = (compile_ignore_patterns(files),
+                   compile_ignore_patterns(dirs))
+    return repo.ignore
+
+
+def walk_tree(repo, dir):
+    """
+    Walk a directory and its sub-directories with os.scandir, reusing the
+    type of each DirEntry, and prune .lgit, nested repositories and the
+    directories ignored by .lgitignore before descending into them.
+    Yield (path, key prefix, file entries) for each directory.
+    """
+    ignore_file, ignore_dir = get_ignore_matchers(repo)
+    start = abspath(dir)
+    prefix = get_index_key(start, repo.root) + '/'
+    stack = [(start, '' if prefix == './' else prefix)]
+    while stack:
+        path, prefix = stack.pop()
+        try:
+            with scandir(path) as iterator:
+                entries = list(iterator)
+        except (PermissionError, FileNotFoundError, NotADirectoryError):
+            continue
+        if path != repo.root and any(entry.name == '.lgit'
+                                     for entry in entries):
+            continue
+        files = []
+        for entry in entries:
+            key = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != '.lgit' and not (ignore_dir and
+                                                  ignore_dir(key)):
+                    stack.append((entry.path, key + '/'))
+            elif (entry.is_file() and 'lgit.py' not in entry.name and
+                  not (ignore_file and ignore_file(key))):
+                files.append(entry)
+        yield path, prefix, files
+
+
+def get_all_files(repo, dir):
+    """Get all files in a directory and its sub-directories."""
+    return [entry.path for _, _, files in walk_tree(repo, dir)
+            for entry in files]
+
+
+def is_walked_file(repo, key):
+    """
+    Check if the walk of the working directory would list a file:
+    it exists and neither it nor a parent directory is ignored.
+    """
+    ignore_file, ignore_dir = get_ignore_matchers(repo)
+    parts = key.split('/')
+    if ('.lgit' in parts or 'lgit.py' in parts[-1] or
+            (ignore_file and ignore_file(key))):
+        return False
+    for position in range(1, len(parts)):
+        parent = '/'.join(parts[:position])
+        if ((ignore_dir and ignore_dir(parent)) or
+                exists(repo.root + '/' + parent + '/.lgit')):
+            return False
+    return isfile(repo.root + '/' + key)
+
+
+def get_index_key(path, root):
+    """
+    Get the key of a file in the index dictionary: its normalized path
+    relative to the repository root, with '/' as separator.
+    """
+    key = relpath(abspath(path), root)
+    return key if sep == '/' else key.replace(sep, '/')
+
+
+def get_path_key(repo, path, base):
+    """
+    Get the index key of a path relative to the directory base, fail if
+    the path is outside the repository.
+    """
+    key = get_index_key(join(base, path), repo.root)
+    if key == '..' or key.startswith('../'):
+        raise LgitError("fatal: '" + path + "' is outside repository")
+    return key
+
+
+def get_file_paths(repo, paths, base):
+    """Get path from arguments (relative to the directory base)."""
+    if '.' in paths:
+        return sorted(get_all_files(repo, base))
+    files = []
+    for path in paths:
+        get_path_key(repo, path, base)
+        full_path = abspath(join(base, path))
+        if isfile(full_path) and '/.lgit/' not in full_path:
+            files.append(full_path)
+        elif isdir(full_path):
+            files += get_all_files(repo, full_path)
+        else:
+            raise LgitError(
+                "fatal: pathspec '" + path + "' did not match any files")
+    return sorted(files)
+
+
+def read_chunks(file):
+    """Yield the content of a binary file in fixed-size chunks."""
+    return iter(lambda: file.read(CHUNK_SIZE), b'')
+
+
+def hash_sha1(path):
+    """
+    Hash content to SHA1, reading the file in binary chunks.
+    Return None if the path is not a regular file.
+    """
+    try:
+        with open(path, 'rb') as file:
+            if not S_ISREG(fstat(file.fileno()).st_mode):
+                return None
+            digest = sha1()
+            for chunk in read_chunks(file):
+                digest.update(chunk)
+            return digest.hexdigest()
+    except OSError:
+        pass
+
+
+def get_content(path):
+    """Get the content of file."""
+    try:
+        with open(path, 'r') as file:
+            return file.read()
+    except (PermissionError, FileNotFoundError):
+        pass
+
+
+def get_stat_data(path):
+    """
+    Get the stat data (ctime, mtime, inode, size) of the file. A path
+    that is not a regular file (missing, a directory, under a file...)
+    is given zeros, like a deleted file.
+    """
+    try:
+        info = stat(path)
+    except OSError:
+        return (0, 0, 0, 0)
+    if not S_ISREG(info.st_mode):
+        return (0, 0, 0, 0)
+    return (info.st_ctime_ns, info.st_mtime_ns, info.st_ino, info.st_size)
+
+
+def get_path_state(path):
+    """
+    Get the stat data of a file or a directory (to detect its changes),
+    None if it cannot be stated.
+    """
+    try:
+        info = stat(path)
+    except OSError:
+        return None
+    return (info.st_ctime_ns, info.st_mtime_ns, info.st_ino, info.st_size)
+
+
+def get_worktree_sha1(path, entry, stat_data, index_mtime):
+    """
+    Get the raw SHA1 (as in the index) of the file in the working directory.
+    Reuse the SHA1 stored in the index when the stat data is unchanged and
+    the file was not modified in the same timestamp tick as the index write
+    (racy), otherwise re-hash the content. Return NULL_SHA if the file was
+    deleted (see get_stat_data).
+    """
+    if is_stat_unchanged(entry, stat_data, index_mtime):
+        return entry.sha
+    if not stat_data[1]:
+        return NULL_SHA
+    return get_raw_digest(hash_sha1(path))
+
+
+def is_stat_unchanged(entry, stat_data, index_mtime):
+    """Check if the SHA1 of the index entry can be trusted for the file."""
+    return (stat_data[1] and stat_data == tuple(entry[:4]) and
+            stat_data[1] < index_mtime)
+
+
+def get_object_path(repo, sha):
+    """Get the path of a loose object in objects directory."""
+    return repo.objects + '/' + sha[:2] + '/' + sha[2:]
+
+
+def write_object_stream(repo, chunks, size, obj_type='blob', object_id=None):
+    """
+    Write an object to the lgit database in one streaming pass:
+    the header ('<type> <size>' and a NUL byte) and the content are
+    zlib-compressed to a temporary file while the content is hashed, then
+    the file is moved to its place in objects directory (under object_id
+    if it is given instead of SHA1 of the content), unless the object is
+    already known: then the temporary file is dropped.
+    Return SHA1 of the object, or None if the content is not size bytes.
+    """
+    from tempfile import mkstemp
+    objects = repo.objects + '/'
+    descriptor, temp_path = mkstemp(dir=objects, prefix='tmp_obj_')
+    digest, compressor, length = sha1(), compressobj(), 0
+    with open(descriptor, 'wb') as temp_file:
+        temp_file.write(compressor.compress(
+            obj_type.encode() + b' ' + str(size).encode() + b'\0'))
+        for chunk in chunks:
+            digest.update(chunk)
+            length += len(chunk)
+            temp_file.write(compressor.compress(chunk))
+        temp_file.write(compressor.flush())
+    if length != size:
+        unlink(temp_path)
+        return None
+    sha = object_id or digest.hexdigest()
+    if is_known_object(repo, sha):
+        unlink(temp_path)
+    else:
+        store_object_file(repo, temp_path, sha, size)
+    return sha
+
+
+def store_object_file(repo, temp_path, sha, size):
+    """
+    Move the temporary file of a new object to its place in objects
+    directory and record its SHA1. Only the new objects get here: the
+    tracer counts them and the size of their content.
+    """
+    objects = repo.objects + '/'
+    create_dir(objects + sha[:2])
+    replace(temp_path, objects + sha[:2] + '/' + sha[2:])
+    log_object_id(repo, sha)
+
+
+def write_object(repo, data, obj_type='blob', object_id=None):
+    """Write an object whose content is in memory to the lgit database."""
+    return write_object_stream(repo, [data], len(data), obj_type, object_id)
+
+
+def parse_object_header(data):
+    """
+    Parse the header of an object ('<type> <size>' and a NUL byte).
+    Return (type, size, rest of data) or None if it is not a header.
+    """
+    match = OBJECT_HEADER.match(data)
+    if not match:
+        return None
+    return (match.group(1).decode(), int(match.group(2)),
+            data[match.end():])
+
+
+def read_object_chunks(repo, sha):
+    """
+    Return the type, the size and a generator of the content chunks of an
+    object. A chunked blob is read as a blob, chunk by chunk.
+    """
+    obj_type, size, chunks = read_raw_object_chunks(repo, sha)
+    if obj_type != 'chunked':
+        return obj_type, size, chunks
+    manifest = [line.split() for line in b''.join(chunks).splitlines()]
+    return ('blob', sum(int(size) for _, size in manifest),
+            read_chunked(repo, manifest))
+
+
+def read_chunked(repo, manifest):
+    """Yield the content of the chunks listed in a chunked blob."""
+    for chunk_sha, _ in manifest:
+        yield from read_raw_object_chunks(repo, chunk_sha.decode())[2]
+
+
+def read_raw_object_chunks(repo, sha):
+    """
+    Return the type, the size and a generator of the content chunks of an
+    object as it is stored. Look up the object in the pack files first,
+    then fall back to the loose objects. Objects written uncompressed by
+    the previous versions are read as they are (as blobs).
+    """
+    for pack in get_packs(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return read_packed_object_chunks(repo, pack, offset)
+    file = open(get_object_path(repo, sha), 'rb')
+    first, decompressor, header = read_loose_header(file)
+    if header is None:
+        file.seek(0)
+        return 'blob', fstat(file.fileno()).st_size, read_legacy(file)
+    obj_type, size, rest = header
+    return obj_type, size, read_compressed(file, decompressor, first, rest)
+
+
+def read_loose_header(file):
+    """
+    Read the first chunk of a loose object file and decompress its header.
+    Return the chunk, the decompressor and the parsed header (None for an
+    object written uncompressed by the previous versions).
+    """
+    first = file.read(CHUNK_SIZE)
+    decompressor = decompressobj()
+    try:
+        header = parse_object_header(decompressor.decompress(first, 64))
+    except zlib_error:
+        header = None
+    return first, decompressor, header
+
+
+def read_legacy(file):
+    """Yield the content of an uncompressed object."""
+    with file:
+        yield from read_chunks(file)
+
+
+def read_compressed(file, decompressor, first, rest):
+    """Yield the decompressed content of a zlib-compressed object."""
+    with file:
+        if rest:
+            yield rest
+        for chunk in chain([decompressor.unconsumed_tail], read_chunks(file)):
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def read_object(repo, sha):
+    """Return the type and the content of an object."""
+    obj_type, _, chunks = read_object_chunks(repo, sha)
+    return obj_type, b''.join(chunks)
+
+
+def read_raw_object(repo, sha):
+    """Return the type and the content of an object as it is stored."""
+    obj_type, _, chunks = read_raw_object_chunks(repo, sha)
+    return obj_type, b''.join(chunks)
+
+
+def is_known_object(repo, sha):
+    """
+    Check if an object is listed in the object-ids files or in a pack,
+    without touching the filesystem.
+    """
+    return (bytes.fromhex(sha) in get_object_ids(repo) or
+            any(pack.find(sha) is not None for pack in get_packs(repo)))
+
+
+def has_object(repo, sha):
+    """
+    Check if an object is in the lgit database. The object-ids files
+    cover all the objects once they exist: the loose objects are only
+    looked up on disk without them.
+    """
+    return is_known_object(repo, sha) or (
+        get_object_ids(repo).map is None and
+        isfile(get_object_path(repo, sha)))
+
+
+class Pack:
+    """
+    A pack file and its index, memory-mapped.
+    The index has a fan-out table (number of objects whose SHA1 starts
+    with a byte <= i), the sorted raw SHA1s and the offsets of the objects
+    in the pack file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.idx', 'rb') as file:
+            self.index = mmap(file.fileno(), 0, access=ACCESS_READ)
+        with open(path + '.pack', 'rb') as file:
+            self.map = mmap(file.fileno(), 0, access=ACCESS_READ)
+        signature, version, self.count = PACK_HEADER.unpack_from(self.index)
+        if signature != PACK_INDEX_SIGNATURE or version != PACK_VERSION:
+            raise LgitError(
+                'fatal: pack index file ' + path + '.idx is corrupt')
+        self.fanout = PACK_FANOUT.unpack_from(self.index, PACK_HEADER.size)
+        self.shas = PACK_HEADER.size + PACK_FANOUT.size
+        self.offsets = self.shas + 20 * self.count
+
+    def get_sha(self, position):
+        start = self.shas + 20 * position
+        return self.index[start:start + 20]
+
+    def find(self, sha):
+        """Return the offset of the object in the pack file, or None."""
+        raw = bytes.fromhex(sha)
+        low = self.fanout[raw[0] - 1] if raw[0] else 0
+        high = self.fanout[raw[0]]
+        while low < high:
+            middle = (low + high) // 2
+            current = self.get_sha(middle)
+            if current == raw:
+                return self.get_offset(middle)
+            if current < raw:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def get_offset(self, position):
+        return PACK_OFFSET.unpack_from(
+            self.index, self.offsets + PACK_OFFSET.size * position)[0]
+
+    def get_delta_base(self, offset):
+        """
+        Return the raw SHA1 of the base of the object at offset if it is
+        stored as a delta, otherwise None.
+        """
+        if not PACK_ENTRY.unpack_from(self.map, offset)[0]:
+            return None
+        start = offset + PACK_ENTRY.size
+        return self.map[start:start + 20]
+
+    def get_shas(self):
+        """Yield SHA1 of the objects in the pack."""
+        for position in range(self.count):
+            yield self.get_sha(position).hex()
+
+
+def get_packs(repo):
+    """Return the packs of the lgit database (loaded once per repository)."""
+    if repo.packs is None:
+        directory = repo.objects + '/pack'
+        try:
+            names = sorted(name[:-4] for name in listdir(directory)
+                           if name.endswith('.idx'))
+        except FileNotFoundError:
+            names = []
+        repo.packs = [Pack(directory + '/' + name) for name in names]
+    return repo.packs
+
+
+def get_object_ids(repo):
+    """Return the object-ids file of the repository (loaded once)."""
+    if repo.object_ids is None:
+        repo.object_ids = ObjectIds(repo.object_ids_path,
+                                    repo.object_ids_log_path)
+    return repo.object_ids
+
+
+class ObjectIds:
+    """
+    The IDs of objects of the lgit database, memory-mapped: a Bloom filter,
+    then a fan-out table and the sorted raw SHA1s (as in a pack index).
+    The filter answers most lookups of a missing object without reading
+    the list, the list confirms the others. The objects written since the
+    list was written are appended to a log file (one hex SHA1 per line,
+    see log_object_id), read to a set, until they are merged into the
+    list by batches. Once the file exists it covers every object of the
+    database, and the objects are only deleted by gc, which removes both
+    files: a listed object is in the database, and an object not listed
+    is not (or its ID was lost by an interrupted write: it is written
+    again).
+    """
+
+    def __init__(self, path, log_path):
+        self.map, self.count, self.size = None, 0, 0
+        try:
+            with open(log_path, 'rb') as file:
+                lines = file.read().split(b'\n')
+        except (PermissionError, FileNotFoundError):
+            lines = []
+        # a line cut by an interrupted write is ignored
+        self.recent = {bytes.fromhex(line.decode()) for line in lines
+                       if OBJECT_ID.fullmatch(line)}
+        try:
+            with open(path, 'rb') as file:
+                self.map = mmap(file.fileno(), 0, access=ACCESS_READ)
+        except (PermissionError, FileNotFoundError):
+            return
+        signature, version, self.count, self.size = (
+            OBJECT_IDS_HEADER.unpack_from(self.map))
+        if (signature != OBJECT_IDS_SIGNATURE or
+                version != OBJECT_IDS_VERSION):
+            raise LgitError('fatal: object-ids file is corrupt')
+        self.fanout = PACK_FANOUT.unpack_from(
+            self.map, OBJECT_IDS_HEADER.size + self.size)
+        self.shas = OBJECT_IDS_HEADER.size + self.size + PACK_FANOUT.size
+
+    @property
+    def capacity(self):
+        """Number of IDs the Bloom filter is sized for."""
+        return self.size * 8 // BLOOM_BITS_PER_ID
+
+    def get_filter(self):
+        return self.map[OBJECT_IDS_HEADER.size:
+                        OBJECT_IDS_HEADER.size + self.size]
+
+    def get_sha(self, position):
+        start = self.shas + 20 * position
+        return self.map[start:start + 20]
+
+    def __contains__(self, raw):
+        return raw in self.recent or self.is_listed(raw)
+
+    def is_listed(self, raw):
+        """Check if a raw SHA1 is in the sorted list."""
+        if not self.count:
+            return False
+        bits = self.size * 8
+        for value in BLOOM_POSITIONS.unpack_from(raw):
+            bit = value % bits
+            if not self.map[OBJECT_IDS_HEADER.size + (bit >> 3)] & (
+                    1 << (bit & 7)):
+                return False
+        low = self.fanout[raw[0] - 1] if raw[0] else 0
+        high = self.fanout[raw[0]]
+        while low < high:
+            middle = (low + high) // 2
+            current = self.get_sha(middle)
+            if current == raw:
+                return True
+            if current < raw:
+                low = middle + 1
+            else:
+                high = middle
+        return False
+
+    def get_shas(self):
+        """Yield the raw SHA1s in sorted order."""
+        for position in range(self.count):
+            yield self.get_sha(position)
+
+
+def fill_bloom_filter(bloom, shas):
+    """Set the bits of the raw SHA1s in a Bloom filter (a bytearray)."""
+    bits = len(bloom) * 8
+    for raw in shas:
+        for value in BLOOM_POSITIONS.unpack_from(raw):
+            bit = value % bits
+            bloom[bit >> 3] |= 1 << (bit & 7)
+
+
+def log_object_id(repo, sha):
+    """
+    Append the ID of an object just written to the object-ids log file,
+    if the object-ids file exists (a missing one is created with all the
+    objects). Each line is appended by one write: the worker processes
+    of add can log their objects at the same time.
+    """
+    ids = get_object_ids(repo)
+    if ids.map is None:
+        return
+    with open(repo.object_ids_log_path, 'ab') as file:
+        file.write(sha.encode() + b'\n')
+    ids.recent.add(bytes.fromhex(sha))
+
+
+def update_object_ids(repo):
+    """
+    Merge the object-ids log file into the object-ids file once it has
+    OBJECT_IDS_BATCH IDs. A missing object-ids file is created with all
+    the objects of the database.
+    """
+    # the IDs logged by the worker processes are read again
+    repo.object_ids = None
+    ids = get_object_ids(repo)
+    if ids.map is not None and len(ids.recent) < OBJECT_IDS_BATCH:
+        return
+    new = set(ids.recent)
+    if ids.map is None:
+        new.update(bytes.fromhex(sha) for sha in get_loose_objects(repo))
+        for pack in get_packs(repo):
+            new.update(pack.get_sha(position)
+                       for position in range(pack.count))
+    write_object_ids(repo, ids, new)
+
+
+def write_object_ids(repo, ids, new):
+    """
+    Write the object-ids file with the IDs of ids and the raw SHA1s new,
+    and remove the log file. The Bloom filter is reused until it holds
+    its capacity of IDs, then it is built again for twice as many.
+    """
+    new = sorted(raw for raw in new if not ids.is_listed(raw))
+    all_shas = list(merge(ids.get_shas(), new))
+    if len(all_shas) <= ids.capacity:
+        bloom = bytearray(ids.get_filter())
+        fill_bloom_filter(bloom, new)
+    else:
+        bloom = bytearray(len(all_shas) * 2 * BLOOM_BITS_PER_ID // 8)
+        fill_bloom_filter(bloom, all_shas)
+    fanout = [bisect_left(all_shas, bytes([byte + 1]))
+              for byte in range(255)] + [len(all_shas)]
+    data = b''.join([OBJECT_IDS_HEADER.pack(
+        OBJECT_IDS_SIGNATURE, OBJECT_IDS_VERSION, len(all_shas),
+        len(bloom)), bloom, PACK_FANOUT.pack(*fanout)] + all_shas)
+    write_lgit_file(repo, repo.object_ids_path, data + sha1(data).digest())
+    try:
+        unlink(repo.object_ids_log_path)
+    except FileNotFoundError:
+        pass
+    repo.object_ids = None
+
+
+def read_packed_object_chunks(repo, pack, offset):
+    """
+    Return the type, the size and a generator of the content chunks of the
+    object at offset in the pack file. A delta is applied to the content
+    of its base object.
+    """
+    is_delta, type_code, size, length = PACK_ENTRY.unpack_from(
+        pack.map, offset)
+    start = offset + PACK_ENTRY.size
+    if not is_delta:
+        return (OBJECT_TYPES[type_code], size,
+                read_packed(pack.map, start, length))
+    return (OBJECT_TYPES[type_code], size,
+            read_delta(repo, pack.map, start, length))
+
+
+def read_delta(repo, data, start, length):
+    """Yield the content of a delta entry of a pack file."""
+    delta = decompress(data[start + 20:start + 20 + length])
+    base = read_raw_object(repo, data[start:start + 20].hex())[1]
+    yield apply_delta(base, delta)
+
+
+def read_packed(data, start, length):
+    """Yield the decompressed content of a range of a pack file."""
+    decompressor = decompressobj()
+    for position in range(start, start + length, CHUNK_SIZE):
+        chunk = decompressor.decompress(
+            data[position:min(position + CHUNK_SIZE, start + length)])
+        if chunk:
+            yield chunk
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+
+def get_delta_blocks(base):
+    """Map each aligned block of the base content to its offset."""
+    blocks = {}
+    for offset in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        blocks.setdefault(base[offset:offset + DELTA_BLOCK], offset)
+    return blocks
+
+
+def get_match_length(base, offset, target, position):
+    """Get the length of the common content of base and target ranges."""
+    length, step = 0, DELTA_BLOCK
+    limit = min(len(base) - offset, len(target) - position)
+    while step:
+        while (length + step <= limit and
+               base[offset + length:offset + length + step] ==
+               target[position + length:position + length + step]):
+            length += step
+            step *= 2
+        step //= 2
+    return length
+
+
+def create_delta(base, blocks, target, max_size):
+    """
+    Encode target as instructions against base:
+    - copy: a range (offset, length) of the base content.
+    - insert: literal bytes of the target content.
+    Return the delta, or None if it is not smaller than max_size.
+    """
+    delta, size = [], 0
+    insert_start = position = 0
+    while position + DELTA_BLOCK <= len(target):
+        offset = blocks.get(target[position:position + DELTA_BLOCK])
+        if offset is None:
+            if size + position - insert_start >= max_size:
+                return None
+            position += 1
+            continue
+        while (position > insert_start and offset and
+               target[position - 1] == base[offset - 1]):
+            position, offset = position - 1, offset - 1
+        length = get_match_length(base, offset, target, position)
+        if position > insert_start:
+            delta.append(b'\1' + DELTA_INSERT.pack(position - insert_start))
+            delta.append(target[insert_start:position])
+            size += 1 + DELTA_INSERT.size + position - insert_start
+        delta.append(b'\0' + DELTA_COPY.pack(offset, length))
+        size += 1 + DELTA_COPY.size
+        if size >= max_size:
+            return None
+        position = insert_start = position + length
+    if insert_start < len(target):
+        delta.append(b'\1' + DELTA_INSERT.pack(len(target) - insert_start))
+        delta.append(target[insert_start:])
+        size += 1 + DELTA_INSERT.size + len(target) - insert_start
+    return b''.join(delta) if size < max_size else None
+
+
+def apply_delta(base, delta):
+    """Rebuild the target content from the base content and the delta."""
+    target, position = [], 0
+    while position < len(delta):
+        if delta[position]:
+            length, = DELTA_INSERT.unpack_from(delta, position + 1)
+            position += 1 + DELTA_INSERT.size
+            target.append(delta[position:position + length])
+            position += length
+        else:
+            offset, length = DELTA_COPY.unpack_from(delta, position + 1)
+            position += 1 + DELTA_COPY.size
+            target.append(base[offset:offset + length])
+    return b''.join(target)
+
+
+def find_chunk_boundary(data):
+    """
+    Return the position of the first byte of data (from CDC_WINDOW - 1)
+    ending a window whose rolling hash is CDC_TARGET, or -1.
+    The hash is the XOR of the values of the window bytes in CDC_TABLES
+    (one byte per table). It is computed for every position at once,
+    without a per-byte loop: the values are the bytes of a big integer,
+    XORed with itself shifted by 1, 2, 4... bytes up to the window size.
+    """
+    size, found = len(data) + CDC_WINDOW, 0
+    for table, target in zip(CDC_TABLES, CDC_TARGET):
+        value, shift = int.from_bytes(data.translate(table), 'little'), 8
+        while shift < 8 * CDC_WINDOW:
+            value ^= value << shift
+            shift *= 2
+        # the bytes equal to the target become zero bytes
+        found |= value ^ int.from_bytes(bytes([target]) * size, 'little')
+    return found.to_bytes(size, 'little').find(
+        b'\0', CDC_WINDOW - 1, len(data))
+
+
+def split_chunks(file):
+    """
+    Yield the content of a binary file in content-defined chunks.
+    A chunk ends with a window of bytes whose rolling hash matches (see
+    find_chunk_boundary): the boundaries only depend on the content
+    around them, so they are found again after an insertion or a
+    deletion elsewhere in the file. The hash is computed by blocks of
+    CDC_BLOCK bytes until a boundary is found.
+    Chunks are between CDC_MIN and CDC_MAX bytes.
+    """
+    buffer, end_of_file = b'', False
+    while buffer or not end_of_file:
+        while not end_of_file and len(buffer) < CDC_MAX:
+            data = file.read(CDC_MAX)
+            end_of_file = not data
+            buffer += data
+        # the first window ends with the last byte of a CDC_MIN chunk
+        start, end = CDC_MIN - CDC_WINDOW, min(CDC_MAX, len(buffer))
+        limit = end
+        while start + CDC_WINDOW <= limit:
+            stop = min(start + CDC_BLOCK, limit)
+            boundary = find_chunk_boundary(buffer[start:stop])
+            if boundary != -1:
+                end = start + boundary + 1
+                break
+            start = stop - CDC_WINDOW + 1
+        yield buffer[:end]
+        buffer = buffer[end:]
+
+
+def add_chunked_file(repo, file, size):
+    """
+    Store a large file as a chunked blob: each chunk is stored once by its
+    SHA1 and the blob is a manifest of chunk SHA1s and sizes, stored under
+    SHA1 of the whole content. Return SHA1 of the content.
+    """
+    digest, manifest, length = sha1(), [], 0
+    for chunk in split_chunks(file):
+        digest.update(chunk)
+        length += len(chunk)
+        chunk_sha = sha1(chunk).hexdigest()
+        if not has_object(repo, chunk_sha):
+            write_object(repo, chunk, 'chunk')
+        manifest.append('{} {}\n'.format(chunk_sha, len(chunk)))
+    if length != size:
+        return None
+    if len(manifest) == 1:
+        # the manifest would have the SHA1 of its only chunk: the content
+        # is stored as a blob instead
+        return write_object(repo, chunk)
+    return write_object(repo, ''.join(manifest).encode(), 'chunked',
+                        digest.hexdigest())
+
+
+def add_file(repo, path):
+    """
+    Hash the file in binary chunks, then write it compressed to the lgit
+    database in a second pass unless the object is already known (files
+    of at least CHUNK_THRESHOLD bytes are stored as chunked blobs, their
+    known chunks are not written).
+    Retry if the file changes while it is being read.
+    Return SHA1 of the content.
+    """
+    for _ in range(3):
+        try:
+            with open(path, 'rb') as file:
+                size = fstat(file.fileno()).st_size
+                if 0 < CHUNK_THRESHOLD <= size:
+                    sha = add_chunked_file(repo, file, size)
+                else:
+                    sha = add_blob_file(repo, file, size)
+        except (PermissionError, FileNotFoundError):
+            return None
+        if sha:
+            return sha
+    raise LgitError(
+        "fatal: '" + path + "' changed while it was being added")
+
+
+def add_blob_file(repo, file, size):
+    """
+    Store a file as a blob, hashing it first: a known object is neither
+    compressed nor written. Return SHA1 of the content, None if the file
+    is not size bytes long.
+    """
+    digest, length = sha1(), 0
+    for chunk in read_chunks(file):
+        digest.update(chunk)
+        length += len(chunk)
+    if length != size:
+        return None
+    sha = digest.hexdigest()
+    if has_object(repo, sha):
+        return sha
+    file.seek(0)
+    return write_object_stream(repo, read_chunks(file), size)
+
+
+def create_info(stat_data, sha, entry):
+    """Create the IndexEntry of a file staged with the raw content SHA1."""
+    commit_sha = entry.commit_sha if entry else NULL_SHA
+    return IndexEntry(*stat_data, sha, sha, commit_sha)
+
+
+def store_file(repo, path):
+    """Store a file in the lgit database, return its stat data and SHA1."""
+    stat_data = get_stat_data(path)
+    return stat_data, add_file(repo, path)
+
+
+def store_files(repo, paths, jobs):
+    """
+    Store the files in a pool of worker processes hashing and writing
+    objects concurrently. Return the results in the order of paths.
+    """
+    store = partial(store_file, repo)
+    if jobs <= 1 or len(paths) < 2 * jobs:
+        return map(store, paths)
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(store, paths,
+                                 chunksize=max(1, len(paths) // jobs // 8)))
+
+
+def get_changed_file_paths(repo, changes, base):
+    """
+    Get the files to add for '.' from the paths reported changed by the
+    fsmonitor daemon: the tracked files changed or not staged yet and the
+    untracked files, in the directory base.
+    """
+    prefix = get_index_key(base, repo.root) + '/'
+    if prefix == './':
+        prefix = ''
+    keys = [path for path, entry in get_index_dict(repo).items()
+            if entry.sha != entry.staged_sha or
+            is_path_changed(path, entry, changes)]
+    keys += get_untracked_files(repo)
+    return sorted(repo.root + '/' + key for key in keys
+                  if key.startswith(prefix) and
+                  isfile(repo.root + '/' + key))
+
+
+def lgit_add(repo, paths, jobs=1, base=None):
+    """
+    Store a copy of the file content in the lgit database. The paths are
+    relative to the directory base (the current directory by default).
+    Return the index keys of the staged files.
+    """
+    base = base or getcwd()
+    acquire_index_lock(repo)
+    index = get_index_dict(repo)
+    index_mtime = get_index_mtime(repo)
+    changes = get_fsmonitor_changes(repo) if '.' in paths else None
+    if changes is not None:
+        paths = get_changed_file_paths(repo, changes, base)
+    else:
+        paths = get_file_paths(repo, paths, base)
+    keys, changed = [], []
+    for path in paths:
+        key = get_index_key(path, repo.root)
+        # the entries of a tree object are separated by newlines
+        if '\n' in key:
+            raise LgitError("fatal: unable to add '{}': file names "
+                            "containing a newline are not supported"
+                            .format(key.replace('\n', '\\n')))
+        entry = index.get(key)
+        # a file whose stat data matches its staged content is skipped
+        if (entry is None or entry.sha != entry.staged_sha or
+                not is_stat_unchanged(entry, get_stat_data(path),
+                                      index_mtime)):
+            changed.append((path, key))
+        keys.append(key)
+    results = store_files(repo, [path for path, _ in changed], jobs)
+    for (path, key), (stat_data, sha) in zip(changed, results):
+        if sha:
+            sha = bytes.fromhex(sha)
+            entry = index.get(key)
+            if entry is None or entry.staged_sha != sha:
+                invalidate_cache_tree(repo, key)
+            index[key] = create_info(stat_data, sha, entry)
+        else:
+            keys.remove(key)
+    update_object_ids(repo)
+    update_index_file(repo, index)
+    return keys
+
+
+def get_delete_key(repo, index, path):
+    """Find the key of index dictionary to delete."""
+    key = get_index_key(path, repo.root)
+    return key if key in index else None
+
+
+def remove_files(repo, paths, base=None):
+    """
+    Remove files from the working directory and the index. The paths are
+    relative to the directory base (the current directory by default).
+    Nothing is removed if a path does not match a tracked file or a
+    directory. Return the paths not removed because they are directories.
+    """
+    base = base or getcwd()
+    acquire_index_lock(repo)
+    index = get_index_dict(repo)
+    keys, directories = [], []
+    for path in paths:
+        get_path_key(repo, path, base)
+        full_path = abspath(join(base, path))
+        key = get_delete_key(repo, index, full_path)
+        if isfile(full_path) and key:
+            keys.append((full_path, key))
+        elif isdir(full_path):
+            directories.append(path)
+        else:
+            raise LgitError(
+                "fatal: pathspec '" + path + "' did not match any files")
+    for path, key in keys:
+        unlink(path)
+        index.pop(key, None)
+        invalidate_cache_tree(repo, key)
+    update_index_file(repo, index)
+    return directories
+
+
+def lgit_remove(repo, paths):
+    """Remove files from the working directory and the index."""
+    for path in remove_files(repo, paths):
+        print("fatal: not removing '" + path + "' recursively")
+
+
+def lgit_config(repo, author):
+    """Set a user for authoring the commits."""
+    try:
+        file = open(repo.config, 'w+')
+        file.write(author + '\n')
+        file.close()
+    except PermissionError:
+        pass
+
+
+def get_author(repo):
+    """Get the author from the config file, fail if it is empty."""
+    author = (get_content(repo.config) or '').strip('\n')
+    if not author:
+        raise LgitError('fatal: no author configured '
+                        '(use "./lgit.py config --author <name>")')
+    return author
+
+
+def create_commit_file(repo, author, message, tst_1, tst_2, parent, tree):
+    """
+    Create a file in commits directory and write the content to it:
+    author, date, parent commit (if any) and root tree, then the message.
+    """
+    header = [author, tst_2]
+    if parent:
+        header.append('parent ' + parent)
+    header.append('tree ' + tree)
+    try:
+        write_lgit_file(repo, repo.commits + '/' + tst_1, '{}\n\n{}\n'.format(
+            '\n'.join(header), message).encode())
+    except PermissionError:
+        pass
+
+
+def get_head(repo):
+    """
+    Get the ID of the latest commit from the HEAD file (or from the
+    commits directory for the repositories without HEAD).
+    """
+    head = (get_content(repo.head) or '').strip()
+    if head:
+        return head
+    commits = listdir(repo.commits)
+    return max(commits) if commits else None
+
+
+def set_head(repo, commit_id):
+    """Write the ID of the latest commit to the HEAD file."""
+    try:
+        write_lgit_file(repo, repo.head, (commit_id + '\n').encode())
+    except PermissionError:
+        pass
+
+
+def read_commit_header(repo, commit_id):
+    """
+    Read the header lines of a commit file (up to the empty line):
+    return its author, date, parent and root tree. The commits written by
+    the previous versions have no parent and no tree lines: their snapshot
+    is the flat file of the same name in snapshots directory.
+    """
+    header = {'snapshot': commit_id}
+    try:
+        with open(repo.commits + '/' + commit_id, 'r') as file:
+            header['author'] = file.readline().rstrip('\n')
+            header['date'] = file.readline().rstrip('\n')
+            for line in file:
+                if line == '\n':
+                    break
+                key, _, value = line.rstrip('\n').partition(' ')
+                header[key] = value
+    except (PermissionError, FileNotFoundError):
+        return None
+    return header
+
+
+def get_commit_timestamp(commit_id):
+    """Get the POSIX timestamp of a commit from its ID."""
+    return int(datetime.strptime(commit_id[:14], '%Y%m%d%H%M%S').timestamp())
+
+
+class CommitGraph:
+    """
+    The commit-graph file, memory-mapped: fixed-width records sorted by
+    commit ID (commit ID, index of the parent record, timestamp, offset
+    and length of the author in the author table), then the author table.
+    The commits made since the file was written are appended to a log
+    file, one '<ID> <parent ID or -> <timestamp> <author>' line each,
+    until they are merged into the file by batches. Their records follow
+    the records of the file.
+    """
+
+    def __init__(self, repo):
+        self.map, self.count = None, 0
+        self.recent, self.positions, self.log_size = [], {}, 0
+        try:
+            with open(repo.commit_graph, 'rb') as file:
+                if file.read(4) == COMMIT_GRAPH_SIGNATURE:
+                    self.map = mmap(file.fileno(), 0, access=ACCESS_READ)
+        except (PermissionError, FileNotFoundError, ValueError):
+            return
+        if self.map is None:
+            return
+        _, version, self.count, _ = COMMIT_GRAPH_HEADER.unpack_from(self.map)
+        if version != COMMIT_GRAPH_VERSION:
+            self.map, self.count = None, 0
+            return
+        self.table = (COMMIT_GRAPH_HEADER.size +
+                      self.count * COMMIT_GRAPH_RECORD.size)
+        self.read_log(repo.commit_graph_log)
+
+    def read_log(self, path):
+        """Read the records of the commits appended to the log file."""
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except (PermissionError, FileNotFoundError):
+            return
+        # a line cut by an interrupted write is ignored
+        self.log_size = data.rfind(b'\n') + 1
+        for line in data[:self.log_size].decode().split('\n')[:-1]:
+            commit_id, parent, timestamp, author = line.split(' ', 3)
+            parent = self.find(parent)
+            self.positions[commit_id] = self.count + len(self.recent)
+            self.recent.append((commit_id, -1 if parent is None else parent,
+                                int(timestamp), author))
+
+    def get(self, position):
+        """Return (ID, parent position, timestamp, author) of a record."""
+        if position >= self.count:
+            return self.recent[position - self.count]
+        commit_id, parent, timestamp, offset, length = (
+            COMMIT_GRAPH_RECORD.unpack_from(
+                self.map, COMMIT_GRAPH_HEADER.size +
+                position * COMMIT_GRAPH_RECORD.size))
+        start = self.table + offset
+        return (commit_id.rstrip(b'\0').decode(), parent, timestamp,
+                self.map[start:start + length].decode())
+
+    def find(self, commit_id):
+        """Return the position of the record of a commit, or None."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            current = self.get(middle)[0]
+            if current == commit_id:
+                return middle
+            if current < commit_id:
+                low = middle + 1
+            else:
+                high = middle
+        return self.positions.get(commit_id)
+
+    def get_records(self):
+        """
+        Return all the records, the records of the file (sorted by commit
+        ID) then the records of the log.
+        """
+        return [self.get(position) for position in range(self.count)] + (
+            self.recent)
+
+    def walk(self, commit_id):
+        """Yield the records from a commit following the parent links."""
+        position = self.find(commit_id)
+        while position is not None and position >= 0:
+            record = self.get(position)
+            yield record
+            position = record[1]
+
+
+def get_commit_graph(repo):
+    """
+    Return the commit graph of the repository, written from the commit
+    files first if it does not exist yet.
+    """
+    graph = CommitGraph(repo)
+    if graph.map is None and listdir(repo.commits):
+        write_commit_graph(repo, get_commit_records(repo))
+        graph = CommitGraph(repo)
+    return graph
+
+
+def get_commit_records(repo):
+    """
+    Read the records of the commit graph from the commit files.
+    A commit without parent line (previous versions) is given the commit
+    before it as parent.
+    """
+    records, previous = [], None
+    for commit_id in sorted(listdir(repo.commits)):
+        header = read_commit_header(repo, commit_id)
+        if header is None:
+            continue
+        parent = header['parent'] if 'parent' in header else previous
+        records.append((commit_id, parent, get_commit_timestamp(commit_id),
+                        header['author']))
+        previous = commit_id
+    return records
+
+
+def write_commit_graph(repo, records):
+    """
+    Write the commit-graph file from (ID, parent ID or position, timestamp,
+    author) records sorted by commit ID.
+    """
+    positions = {record[0]: position
+                 for position, record in enumerate(records)}
+    authors, table, packed = {}, [], []
+    size = 0
+    for commit_id, parent, timestamp, author in records:
+        if author not in authors:
+            data = author.encode()
+            authors[author] = (size, len(data))
+            table.append(data)
+            size += len(data)
+        if isinstance(parent, str):
+            parent = positions.get(parent, -1)
+        elif parent is None:
+            parent = -1
+        packed.append(COMMIT_GRAPH_RECORD.pack(
+            commit_id.encode(), parent, timestamp, *authors[author]))
+    data = b''.join([COMMIT_GRAPH_HEADER.pack(
+        COMMIT_GRAPH_SIGNATURE, COMMIT_GRAPH_VERSION, len(packed), size)] +
+        packed + table)
+    try:
+        write_lgit_file(repo, repo.commit_graph, data + sha1(data).digest())
+        unlink(repo.commit_graph_log)
+    except (PermissionError, FileNotFoundError):
+        pass
+
+
+def add_commit_to_graph(repo, commit_id, parent, author):
+    """
+    Append a new commit to the commit-graph log file, or merge the log
+    into the commit-graph file once it has COMMIT_GRAPH_BATCH commits.
+    """
+    graph = CommitGraph(repo)
+    if graph.map is None:
+        write_commit_graph(repo, get_commit_records(repo))
+        return
+    timestamp = get_commit_timestamp(commit_id)
+    if len(graph.recent) + 1 < COMMIT_GRAPH_BATCH:
+        try:
+            with open(repo.commit_graph_log, 'ab') as file:
+                file.truncate(graph.log_size)
+                file.write('{} {} {} {}\n'.format(
+                    commit_id, parent or '-', timestamp, author).encode())
+        except PermissionError:
+            pass
+        return
+    records = graph.get_records()
+    # the records are sorted again with their parent IDs, in case the
+    # clock went back between two commits
+    write_commit_graph(repo, sorted(
+        [(record_id, records[position][0] if position >= 0 else None,
+          record_timestamp, record_author)
+         for record_id, position, record_timestamp, record_author in records] +
+        [(commit_id, parent, timestamp, author)]))
+
+
+def write_tree(repo, entries):
+    """
+    Write a tree object from a dictionary mapping names to (type, SHA1),
+    one '<type> <SHA1> <name>' line per entry sorted by name.
+    The tree is content-addressed: an identical tree is written once.
+    Return SHA1 of the tree.
+    """
+    data = ''.join('{} {} {}\n'.format(obj_type, sha, name)
+                   for name, (obj_type, sha) in sorted(entries.items()))
+    data = data.encode('utf-8', 'surrogateescape')
+    sha = sha1(data).hexdigest()
+    if not has_object(repo, sha):
+        write_object(repo, data, 'tree')
+    return sha
+
+
+def write_index_tree(repo, index):
+    """
+    Write the tree objects of the staged content of the index.
+    The directories of the cache tree are reused as they are, only the
+    invalidated ones are written again (and cached).
+    Return SHA1 of the root tree.
+    """
+    cache = get_cache_tree(repo)
+    keys = sorted(index)
+    cached = cache.get('')
+    if cached is None or cached[0] != len(keys):
+        cached = (len(keys), write_cached_tree(repo, index, cache, keys,
+                                               0, len(keys), ''))
+        cache[''] = cached
+    return cached[1]
+
+
+def write_cached_tree(repo, index, cache, keys, start, end, prefix):
+    """
+    Write the tree of a directory whose files are keys[start:end] (sorted
+    paths starting with prefix). The range of a subdirectory is found by
+    binary search so the cached subdirectories are skipped without
+    looking at their files. Return SHA1 of the tree.
+    """
+    entries = {}
+    position = start
+    while position < end:
+        name, slash, _ = keys[position][len(prefix):].partition('/')
+        if not slash:
+            entries[name] = ('blob', index[keys[position]].staged_sha.hex())
+            position += 1
+            continue
+        dir = prefix + name
+        # '0' follows '/': the paths under dir are before dir + '0'
+        stop = bisect_left(keys, dir + '0', position, end)
+        cached = cache.get(dir)
+        if cached is None or cached[0] != stop - position:
+            cached = (stop - position, write_cached_tree(
+                repo, index, cache, keys, position, stop, dir + '/'))
+            cache[dir] = cached
+        entries[name] = ('tree', cached[1])
+        position = stop
+    return write_tree(repo, entries)
+
+
+def read_tree(repo, sha):
+    """Return the (name, type, SHA1) entries of a tree object."""
+    _, data = read_object(repo, sha)
+    # split on '\n' only: splitlines also splits names on other breaks
+    return [(line[46:], line[:4], line[5:45]) for line in
+            data.decode('utf-8', 'surrogateescape').split('\n')[:-1]]
+
+
+def get_tree_entries(repo, sha, prefix='', seen=None):
+    """
+    Yield (SHA1, path) of the objects of a tree, recursively. The trees
+    in seen (SHA1 of the trees already walked) are skipped.
+    """
+    for name, obj_type, entry_sha in read_tree(repo, sha):
+        if obj_type == 'tree':
+            if seen is not None:
+                if entry_sha in seen:
+                    continue
+                seen.add(entry_sha)
+            yield entry_sha, prefix + name
+            yield from get_tree_entries(repo, entry_sha,
+                                        prefix + name + '/', seen)
+        else:
+            yield entry_sha, prefix + name
+
+
+def diff_trees(repo, old, new, prefix=''):
+    """
+    Yield (path, old SHA1, new SHA1) of the files which differ between
+    two trees (None if it is missing on one side). The subtrees with the
+    same SHA1 are identical and are not read.
+    """
+    if old == new:
+        return
+    old_entries = {name: (obj_type, sha) for name, obj_type, sha in
+                   (read_tree(repo, old) if old else [])}
+    new_entries = {name: (obj_type, sha) for name, obj_type, sha in
+                   (read_tree(repo, new) if new else [])}
+    for name in sorted(old_entries.keys() | new_entries.keys()):
+        old_type, old_sha = old_entries.get(name, (None, None))
+        new_type, new_sha = new_entries.get(name, (None, None))
+        if old_sha == new_sha:
+            continue
+        yield from diff_trees(repo, old_sha if old_type == 'tree' else None,
+                              new_sha if new_type == 'tree' else None,
+                              prefix + name + '/')
+        if old_type != 'tree' and new_type != 'tree':
+            yield prefix + name, old_sha, new_sha
+        elif old_type == 'blob' or new_type == 'blob':
+            yield (prefix + name, old_sha if old_type == 'blob' else None,
+                   new_sha if new_type == 'blob' else None)
+
+
+def create_snap_file(repo, index):
+    """
+    Update the SHA1 of the file content after you lgit commit in the index
+    entries of the staged files. The stat data and the SHA1 of the working
+    directory are kept from the stat cache: a commit does not change the
+    working directory, so no file is opened or stat'ed.
+    Then write the snapshot as tree objects and return SHA1 of its root.
+    """
+    for path, entry in index.items():
+        if entry.commit_sha != entry.staged_sha:
+            index[path] = entry._replace(commit_sha=entry.staged_sha)
+    return write_index_tree(repo, index)
+
+
+def lgit_commit(repo, message):
+    """
+    Create a commit with the changes currently staged.
+    Return the ID of the commit.
+    """
+    author = get_author(repo)
+    # the index lock also serializes the updates of HEAD
+    acquire_index_lock(repo)
+    cur_time = datetime.fromtimestamp(time())
+    commit_id = cur_time.strftime('%Y%m%d%H%M%S.%f')
+    parent = get_head(repo)
+    index = get_index_dict(repo)
+    tree = create_snap_file(repo, index)
+    create_commit_file(repo, author, message, commit_id,
+                       cur_time.strftime('%Y%m%d%H%M%S'), parent, tree)
+    set_head(repo, commit_id)
+    add_commit_to_graph(repo, commit_id, parent, author)
+    update_index_file(repo, index)
+    return commit_id
+
+
+def print_on_branch(head):
+    print('On branch master\n')
+    if not head:
+        print('No commits yet\n')
+
+
+def get_examined_entries(repo):
+    """
+    Return the index entries which may differ from the working directory
+    or from HEAD: all of them without the fsmonitor daemon, otherwise the
+    paths it reported changed, the entries without valid stat data and
+    the entries with changes already recorded (staged or not). These are
+    found in the memory-mapped index without parsing the other entries.
+    """
+    changes = get_fsmonitor_changes(repo)
+    mapped = get_mapped_index(repo)
+    if changes is None or repo.index is not None or mapped.map is None:
+        return get_index_dict(repo)
+    entries = {}
+    for position, record in enumerate(mapped.get_records()):
+        if not record[1] or record[4] != record[5] or record[5] != record[6]:
+            entries[mapped.get_path(position)] = IndexEntry._make(record)
+    for key in changes:
+        if key.endswith('/'):
+            entries.update(mapped.find_prefix(key))
+        else:
+            entry = mapped.find(key)
+            if entry is not None:
+                entries[key] = entry
+    return entries
+
+
+def get_status_paths_list(repo):
+    """
+    Update the index entries (only the paths reported changed by the
+    fsmonitor daemon if it is running, see get_examined_entries):
+    - stat data of the file in the working directory.
+    - SHA1 of the content in the working directory.
+    Check SHA1 of 3 stages to return a list to print status.
+    """
+    entries = get_examined_entries(repo)
+    index_mtime = get_index_mtime(repo)
+    changes = get_fsmonitor_changes(repo)
+    to_be_committed, not_staged_for_commit, updated = [], [], {}
+    for path, entry in entries.items():
+        if is_path_changed(path, entry, changes):
+            full_path = repo.root + '/' + path
+            stat_data = get_stat_data(full_path)
+            sha = get_worktree_sha1(full_path, entry, stat_data, index_mtime)
+            new_entry = entry._replace(
+                ctime=stat_data[0], mtime=stat_data[1],
+                ino=stat_data[2], size=stat_data[3], sha=sha)
+            if new_entry != entry:
+                updated[path] = new_entry
+        else:
+            sha = entry.sha
+        if entry.staged_sha != entry.commit_sha:
+            to_be_committed.append(path)
+        if entry.staged_sha != sha:
+            not_staged_for_commit.append(path)
+    if updated:
+        # the whole index is only parsed to save the new stat data
+        get_index_dict(repo).update(updated)
+        repo.index_changed = True
+    return [sorted(to_be_committed), sorted(not_staged_for_commit)]
+
+
+def print_to_be_committed(paths):
+    if paths:
+        print('Changes to be committed:')
+        print('  (use "./lgit.py reset HEAD ..." to unstage)')
+        print('\n\t modified: %s\n' % '\n\t modified: '.join(paths))
+
+
+def print_not_staged_for_commit(paths):
+    if paths:
+        print('Changes not staged for commit:')
+        print('  (use "./lgit.py add ..." to update what will be committed)')
+        print('  (use "./lgit.py checkout -- ..." '
+              'to discard changes in working directory)')
+        print('\n\t modified: %s\n' % '\n\t modified: '.join(paths))
+
+
+def get_untracked_files(repo):
+    """
+    Get list of untracked files in the working directory.
+    If the fsmonitor daemon is running, update the list cached in the
+    index with the paths it reported changed instead of walking the
+    whole working directory.
+    """
+    changes = get_fsmonitor_changes(repo)
+    extensions = get_index_extensions(repo)
+    cached = extensions.get(UNTRACKED_EXTENSION)
+    if changes is None or cached is None:
+        untracked_files = {get_index_key(path, repo.root)
+                           for path in get_all_files(repo, repo.root)}
+        untracked_files.difference_update(
+            repo.index if repo.index is not None else
+            get_mapped_index(repo).get_paths())
+    else:
+        untracked_files = set(filter(None, cached.decode(
+            'utf-8', 'surrogateescape').split('\0')))
+        update_untracked_files(repo, untracked_files, changes)
+        # the few untracked files are looked up in the mapped index
+        tracked = (repo.index if repo.index is not None else
+                   get_mapped_index(repo))
+        untracked_files = {path for path in untracked_files
+                           if path not in tracked}
+    untracked_files = sorted(untracked_files)
+    if repo.fsmonitor_token:
+        data = '\0'.join(untracked_files).encode('utf-8', 'surrogateescape')
+        if data != cached:
+            extensions[UNTRACKED_EXTENSION] = data
+            repo.index_changed = True
+    return untracked_files
+
+
+def update_untracked_files(repo, untracked_files, changes):
+    """Update the set of untracked files with the changed paths."""
+    for key in changes:
+        if not key.endswith('/'):
+            if is_walked_file(repo, key):
+                untracked_files.add(key)
+            else:
+                untracked_files.discard(key)
+            continue
+        untracked_files.difference_update(
+            [path for path in untracked_files if path.startswith(key)])
+        if isdir(repo.root + '/' + key):
+            untracked_files.update(
+                get_index_key(path, repo.root)
+                for path in get_all_files(repo, repo.root + '/' + key))
+
+
+def print_untracked_files(paths):
+    if paths:
+        print('Untracked files:')
+        print('  (use "./lgit.py add <file>..." '
+              'to include in what will be committed)')
+        print('\n\t%s\n' % '\n\t'.join(paths))
+        print('nothing added to commit but untracked files present '
+              '(use "./lgit.py add" to track)')
+
+
+def get_status(repo):
+    """
+    Update the index with the content of the working directory.
+    Return the Status of tracked/untracked files.
+    """
+    head = get_head(repo)
+    paths_list = get_status_paths_list(repo)
+    untracked_files = get_untracked_files(repo)
+    save_fsmonitor_token(repo)
+    if repo.index_changed:
+        update_index_file(repo, get_index_dict(repo))
+    return Status(head, *paths_list, untracked_files)
+
+
+def lgit_status(repo):
+    """Display the status of tracked/untracked files."""
+    status = get_status(repo)
+    print_on_branch(status.head)
+    print_to_be_committed(status.staged)
+    print_not_staged_for_commit(status.unstaged)
+    print_untracked_files(status.untracked)
+
+
+def get_datetime(filename):
+    """Get string of datetime from filename."""
+    dt = datetime(
+        year=int(filename[0:4]),
+        month=int(filename[4:6]),
+        day=int(filename[6:8]),
+        hour=int(filename[8:10]),
+        minute=int(filename[10:12]),
+        second=int(filename[12:14]))
+    return dt.strftime('%a %b %d %H:%M:%S %Y')
+
+
+def read_commit_message(repo, commit_id):
+    """Read the message of a commit, skipping its header lines."""
+    try:
+        with open(repo.commits + '/' + commit_id, 'r') as file:
+            for line in file:
+                if line == '\n':
+                    break
+            return file.read().rstrip('\n')
+    except (PermissionError, FileNotFoundError):
+        return ''
+
+
+def get_log_records(repo, since=None, until=None, author=None):
+    """
+    Yield the commit graph records from HEAD, newest first.
+    The filters only use the commit graph: the walk stops at the first
+    commit older than since and no commit file is opened.
+    """
+    head = get_head(repo)
+    if not head:
+        return
+    match = compile_regex(author).search if author else None
+    for record in get_commit_graph(repo).walk(head):
+        if since is not None and record[2] < since:
+            return
+        if until is not None and record[2] > until:
+            continue
+        if match is not None and not match(record[3]):
+            continue
+        yield record
+
+
+def get_log(repo, count=None, since=None, until=None, author=None):
+    """
+    Yield the Commits of the history from HEAD, newest first (see
+    get_log_records), reading the message of the yielded commits only.
+    """
+    graph = get_commit_graph(repo)
+    for record in islice(get_log_records(repo, since, until, author), count):
+        commit_id, parent, timestamp, commit_author = record
+        yield Commit(commit_id, graph.get(parent)[0] if parent >= 0 else None,
+                     commit_author, datetime.fromtimestamp(timestamp),
+                     read_commit_message(repo, commit_id))
+
+
+def format_commit(commit):
+    """Format a commit of the history."""
+    return 'commit {}\nAuthor: {}\nDate: {}\n\n{}\n'.format(
+        commit.id, commit.author, get_datetime(commit.id),
+        '\n'.join('\t' + line for line in commit.message.split('\n')))
+
+
+def parse_log_date(value):
+    """Parse a --since/--until date: a POSIX timestamp or an ISO date."""
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise ArgumentTypeError('invalid date: ' + value)
+
+
+def open_pager():
+    """
+    Start the pager ($LGIT_PAGER, $PAGER or less) when the output is a
+    terminal and return it, or return None to write to stdout.
+    """
+    command = environ.get('LGIT_PAGER', environ.get('PAGER', 'less'))
+    if not sys.stdout.isatty() or command in ('', 'cat'):
+        return None
+    from subprocess import Popen, PIPE
+    env = dict(environ)
+    env.setdefault('LESS', 'FRX')
+    try:
+        return Popen(command, shell=True, stdin=PIPE, env=env,
+                     universal_newlines=True)
+    except OSError:
+        return None
+
+
+def lgit_log(repo, count=None, since=None, until=None, author=None):
+    """
+    Show the commit history, walking the parent links of the commit graph
+    from HEAD instead of listing and sorting the commits directory.
+    Each commit is written to the pager as soon as it is formatted.
+    """
+    commits = get_log(repo, count, since, until, author)
+    pager = open_pager()
+    output = pager.stdin if pager else sys.stdout
+    try:
+        for number, commit in enumerate(commits):
+            output.write(('\n\n' if number else '') + format_commit(commit))
+            output.flush()
+    except BrokenPipeError:
+        pass
+    finally:
+        if pager:
+            try:
+                pager.stdin.close()
+            except BrokenPipeError:
+                pass
+            pager.wait()
+
+
+def get_tracked_files(repo, prefix=''):
+    """
+    Yield the files currently tracked in the index whose path (from the
+    repository root) starts with prefix.
+    """
+    changes = get_fsmonitor_changes(repo)
+    for path, entry in get_mapped_index(repo).items():
+        if path.startswith(prefix) and (
+                not is_path_changed(path, entry, changes) or
+                isfile(repo.root + '/' + path)):
+            yield path
+
+
+def lgit_ls_files(repo):
+    """
+    List all the files currently tracked in the index,
+    relative to the current directory.
+    """
+    prefix = get_index_key(getcwd(), repo.root) + '/'
+    if prefix == './':
+        prefix = ''
+    for path in get_tracked_files(repo, prefix):
+        print(path[len(prefix):])
+
+
+def resolve_commit(repo, name):
+    """Get the ID of a commit from HEAD, its ID or a unique prefix of it."""
+    if name == 'HEAD':
+        head = get_head(repo)
+        if head:
+            return head
+    else:
+        commits = [commit_id for commit_id in listdir(repo.commits)
+                   if commit_id.startswith(name)]
+        if name in commits:
+            return name
+        if len(commits) == 1:
+            return commits[0]
+    raise LgitError("fatal: bad revision '" + name + "'")
+
+
+def get_commit_files(repo, commit_id):
+    """Map the paths of the files of a commit snapshot to their SHA1."""
+    if commit_id is None:
+        return {}
+    header = read_commit_header(repo, commit_id) or {}
+    if 'tree' in header:
+        return {path: sha for path, _, sha in
+                diff_trees(repo, None, header['tree'])}
+    return {path: sha for sha, path in
+            get_snapshot_entries(repo, header.get('snapshot', commit_id))}
+
+
+def get_worktree_file_sha1(repo, path, entry, index_mtime):
+    """
+    Get SHA1 of a file of the working directory (from the stat cache if
+    it is tracked), None if it does not exist.
+    """
+    full_path = repo.root + '/' + path
+    if entry is None:
+        return hash_sha1(full_path)
+    stat_data = get_stat_data(full_path)
+    if not stat_data[1]:
+        return None
+    return get_hex_digest(
+        get_worktree_sha1(full_path, entry, stat_data, index_mtime))
+
+
+def get_worktree_files(repo, entries=None):
+    """
+    Map the paths of the tracked files (or of the index entries given) to
+    SHA1 of their content in the working directory (from the stat cache,
+    and only for the paths reported changed if the fsmonitor daemon is
+    running), None if they were deleted.
+    """
+    index_mtime = get_index_mtime(repo)
+    changes = get_fsmonitor_changes(repo)
+    if entries is None:
+        entries = get_index_dict(repo)
+    return {path: get_worktree_file_sha1(repo, path, entry, index_mtime)
+            if is_path_changed(path, entry, changes) else
+            get_hex_digest(entry.sha)
+            for path, entry in entries.items()}
+
+
+def diff_commits(repo, old, new):
+    """
+    Yield (path, old SHA1, new SHA1) of the files which differ between two
+    commits (None for no commit): the identical subtrees are skipped.
+    """
+    headers = [read_commit_header(repo, commit_id) or {} if commit_id
+               else {'tree': None} for commit_id in (old, new)]
+    if all('tree' in header for header in headers):
+        yield from diff_trees(repo, headers[0]['tree'], headers[1]['tree'])
+    else:
+        yield from diff_file_maps(get_commit_files(repo, old),
+                                  get_commit_files(repo, new))
+
+
+def diff_file_maps(old, new):
+    """Yield (path, old SHA1, new SHA1) of the paths whose SHA1 differ."""
+    for path in sorted(old.keys() | new.keys()):
+        if old.get(path) != new.get(path):
+            yield path, old.get(path), new.get(path)
+
+
+def get_diff_files(repo, commits, cached):
+    """
+    Yield (path, old SHA1, new SHA1) of the files which differ between:
+    - the index and the working directory (no commit),
+    - a commit (HEAD by default) and the index (cached),
+    - a commit and the working directory,
+    - two commits (the identical subtrees are skipped).
+    SHA1 is None when the file does not exist on one side. The files are
+    compared by SHA1 only: the same files are not read.
+    """
+    commits = [resolve_commit(repo, name) for name in commits]
+    if len(commits) == 2:
+        yield from diff_commits(repo, *commits)
+        return
+    if commits or cached:
+        old = get_commit_files(repo, commits[0] if commits else
+                               get_head(repo))
+        if cached:
+            new = {path: entry.staged_sha.hex()
+                   for path, entry in get_index_dict(repo).items()}
+        else:
+            new = get_worktree_files(repo)
+    else:
+        # only the entries which may differ from the working directory
+        entries = get_examined_entries(repo)
+        old = {path: entry.staged_sha.hex()
+               for path, entry in entries.items()}
+        new = get_worktree_files(repo, entries)
+    yield from diff_file_maps(old, new)
+
+
+def read_diff_content(repo, path, sha, worktree):
+    """
+    Read the content of a side of a diff: the blob, or the file of the
+    working directory (memory-mapped) if its SHA1 is not in the index.
+    """
+    if sha is None:
+        return b''
+    if worktree:
+        try:
+            with open(repo.root + '/' + path, 'rb') as file:
+                if fstat(file.fileno()).st_size:
+                    return mmap(file.fileno(), 0, access=ACCESS_READ)
+                return b''
+        except (PermissionError, FileNotFoundError):
+            return b''
+    return read_object(repo, sha)[1]
+
+
+def get_common_prefix(old, new):
+    """
+    Get the length of the common prefix of two buffers: compare blocks of
+    DIFF_BLOCK bytes, then bisect the first different block.
+    """
+    size = min(len(old), len(new))
+    start = 0
+    while start < size:
+        end = min(start + DIFF_BLOCK, size)
+        if old[start:end] != new[start:end]:
+            break
+        start = end
+    else:
+        return size
+    while start < end:
+        middle = (start + end) // 2
+        if old[start:middle + 1] == new[start:middle + 1]:
+            start = middle + 1
+        else:
+            end = middle
+    return start
+
+
+def get_common_suffix(old, new, limit):
+    """Get the length (up to limit) of the common suffix of two buffers."""
+    old_size, new_size = len(old), len(new)
+    length = 0
+    while length < limit:
+        end = min(length + DIFF_BLOCK, limit)
+        if (old[old_size - end:old_size - length] !=
+                new[new_size - end:new_size - length]):
+            break
+        length = end
+    else:
+        return limit
+    while length < end:
+        middle = (length + end) // 2
+        if (old[old_size - middle - 1:old_size - length] ==
+                new[new_size - middle - 1:new_size - length]):
+            length = middle + 1
+        else:
+            end = middle
+    return length
+
+
+def get_line_hashes(data):
+    """
+    Return the hashes of the lines of data (compared by the diff instead
+    of the lines) and the offset of each line in data. The lines are split
+    by blocks of about DIFF_BLOCK bytes, so only the lines of one block
+    are held at a time.
+    """
+    hashes, offsets, start = [], [0], 0
+    while start < len(data):
+        end = data.find(b'\n', start + DIFF_BLOCK) + 1 or len(data)
+        lines = data[start:end].split(b'\n')
+        last = lines.pop()
+        hashes += map(hash, lines)
+        offsets += islice(accumulate(map((1).__add__, map(len, lines)),
+                                     initial=start), 1, None)
+        if last:
+            # a last line without end of line differs from the same line
+            # with one
+            hashes.append(hash((last,)))
+            offsets.append(end)
+        start = end
+    return hashes, offsets
+
+
+def find_middle_snake(old, new, left, right, top, bottom, budget):
+    """
+    Find the middle snake of the shortest edit script of old[left:right]
+    and new[top:bottom], searching forwards and backwards at the same time
+    (Myers, linear space). Return its start and end points.
+    As xdiff does, the search stops at an edit cost of about the square
+    root of the size: the furthest point reached forwards is returned
+    instead, as an empty snake, and the script is no longer minimal.
+    The diagonals searched are taken from budget (a one-item list shared
+    by the whole diff): None is returned once it is spent.
+    """
+    delta = (right - left) - (bottom - top)
+    max_d = (right - left + bottom - top + 1) // 2
+    max_cost = max(DIFF_MAX_COST_MIN, isqrt(right - left + bottom - top))
+    forward = [0] * (2 * max_d + 1)
+    backward = [0] * (2 * max_d + 1)
+    forward[1], backward[1] = left, bottom
+    for d in range(max_d + 1):
+        if d > max_cost:
+            return get_furthest_point(forward, d - 1, left, right, top,
+                                      bottom)
+        budget[0] -= 2 * d + 2
+        if budget[0] < 0:
+            return None
+        for k in range(d, -d - 1, -2):
+            c = k - delta
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = previous_x = forward[k + 1]
+            else:
+                previous_x = forward[k - 1]
+                x = previous_x + 1
+            y = top + (x - left) - k
+            previous_y = y if d == 0 or x != previous_x else y - 1
+            while x < right and y < bottom and old[x] == new[y]:
+                x, y = x + 1, y + 1
+            forward[k] = x
+            if delta & 1 and -(d - 1) <= c <= d - 1 and y >= backward[c]:
+                return previous_x, previous_y, x, y
+        for c in range(d, -d - 1, -2):
+            k = c + delta
+            if c == -d or (c != d and backward[c - 1] > backward[c + 1]):
+                y = previous_y = backward[c + 1]
+            else:
+                previous_y = backward[c - 1]
+                y = previous_y - 1
+            x = left + (y - top) + k
+            previous_x = x if d == 0 or y != previous_y else x + 1
+            while x > left and y > top and old[x - 1] == new[y - 1]:
+                x, y = x - 1, y - 1
+            backward[c] = y
+            if not delta & 1 and -d <= k <= d and x <= forward[k]:
+                return x, y, previous_x, previous_y
+
+
+def get_furthest_point(forward, d, left, right, top, bottom):
+    """
+    Return the point of the box reached forwards with d edits that is the
+    furthest from its start, as an empty snake.
+    """
+    best = None
+    for k in range(d, -d - 1, -2):
+        x = forward[k]
+        y = top + (x - left) - k
+        if (x <= right and top <= y <= bottom and
+                (best is None or x + y > best[0] + best[1])):
+            best = x, y
+    return best + best
+
+
+def find_matching_blocks(old, new, left, right, top, bottom, blocks,
+                         budget):
+    """
+    Append the (old position, new position, length) blocks of the equal
+    lines of a shortest edit script of old[left:right] and new[top:bottom]
+    to blocks, in order. Once the budget of the search is spent (see
+    find_middle_snake), the lines between the common prefix and suffix of
+    a region are left as one change.
+    """
+    start = left
+    while left < right and top < bottom and old[left] == new[top]:
+        left, top = left + 1, top + 1
+    if left > start:
+        blocks.append((start, top - (left - start), left - start))
+    end = right
+    while left < right and top < bottom and old[right - 1] == new[bottom - 1]:
+        right, bottom = right - 1, bottom - 1
+    snake = None
+    if left < right and top < bottom and budget[0] > 0:
+        snake = find_middle_snake(old, new, left, right, top, bottom, budget)
+    if snake is not None:
+        x1, y1, x2, y2 = snake
+        find_matching_blocks(old, new, left, x1, top, y1, blocks, budget)
+        find_matching_blocks(old, new, x1, x2, y1, y2, blocks, budget)
+        find_matching_blocks(old, new, x2, right, y2, bottom, blocks, budget)
+    if end > right:
+        blocks.append((right, bottom, end - right))
+
+
+def get_matching_blocks(old, new):
+    """
+    Return the (old position, new position, length) blocks of the equal
+    lines of an edit script of old and new. As xdiff does, the lines of
+    a side that are not in the other are discarded first: they cannot
+    match, and the edit script of the lines left is found much faster
+    when many lines changed.
+    """
+    old_set, new_set = set(old), set(new)
+    old_kept = [number for number, line in enumerate(old) if line in new_set]
+    new_kept = [number for number, line in enumerate(new) if line in old_set]
+    blocks, budget = [], [DIFF_MAX_WORK]
+    if len(old_kept) == len(old) and len(new_kept) == len(new):
+        find_matching_blocks(old, new, 0, len(old), 0, len(new), blocks,
+                             budget)
+        return blocks
+    find_matching_blocks([old[number] for number in old_kept],
+                         [new[number] for number in new_kept],
+                         0, len(old_kept), 0, len(new_kept), blocks, budget)
+    # a block of the lines left is split where discarded lines were
+    result = []
+    for old_start, new_start, length in blocks:
+        for number in range(length):
+            old_line = old_kept[old_start + number]
+            new_line = new_kept[new_start + number]
+            if (result and result[-1][0] + result[-1][2] == old_line and
+                    result[-1][1] + result[-1][2] == new_line):
+                result[-1][2] += 1
+            else:
+                result.append([old_line, new_line, 1])
+    return [tuple(block) for block in result]
+
+
+def get_hunks(blocks, old_count, new_count, context):
+    """
+    Group the changes between the matching blocks in hunks of changes
+    separated by at most 2 * context equal lines.
+    Return lists of (old start, old end, new start, new end) changes.
+    """
+    hunks, old_line, new_line = [], 0, 0
+    for old_start, new_start, length in blocks + [(old_count, new_count, 0)]:
+        if old_line < old_start or new_line < new_start:
+            change = (old_line, old_start, new_line, new_start)
+            if hunks and old_line - hunks[-1][-1][1] <= 2 * context:
+                hunks[-1].append(change)
+            else:
+                hunks.append([change])
+        old_line, new_line = old_start + length, new_start + length
+    return hunks
+
+
+def format_range(start, length):
+    """Format a range of lines of a hunk header."""
+    if length == 1:
+        return str(start + 1)
+    return '{},{}'.format(start + 1 if length else start, length)
+
+
+def format_diff_line(tag, data, start, end):
+    line = data[start:end].decode('utf-8', 'replace')
+    if not line.endswith('\n'):
+        line += '\n\\ No newline at end of file\n'
+    return tag + line
+
+
+def diff_buffers(old, new, context=DIFF_CONTEXT):
+    """
+    Yield the hunks of the unified diff of two buffers (text). The common
+    prefix and suffix are skipped by comparing bytes, only the lines in
+    between (and their context) are split and compared by hash.
+    """
+    prefix = get_common_prefix(old, new)
+    suffix = get_common_suffix(old, new, min(len(old), len(new)) - prefix)
+    old_end, new_end = len(old) - suffix, len(new) - suffix
+    start = old.rfind(b'\n', 0, prefix) + 1
+    for _ in range(context):
+        if start:
+            start = old.rfind(b'\n', 0, start - 1) + 1
+    if ((old_end > start and old[old_end - 1] != 10) or
+            (new_end > start and new[new_end - 1] != 10)):
+        position = old.find(b'\n', old_end)
+        length = (position + 1 if position != -1 else len(old)) - old_end
+        old_end, new_end = old_end + length, new_end + length
+    for _ in range(context):
+        if old_end < len(old):
+            position = old.find(b'\n', old_end)
+            length = (position + 1 if position != -1 else len(old)) - old_end
+            old_end, new_end = old_end + length, new_end + length
+    line = old.count(b'\n', 0, start)
+    old_hashes, old_offsets = get_line_hashes(old[start:old_end])
+    new_hashes, new_offsets = get_line_hashes(new[start:new_end])
+    blocks = get_matching_blocks(old_hashes, new_hashes)
+    for hunk in get_hunks(blocks, len(old_hashes), len(new_hashes), context):
+        old_line = max(0, hunk[0][0] - context)
+        new_line = hunk[0][2] - (hunk[0][0] - old_line)
+        old_stop = min(len(old_hashes), hunk[-1][1] + context)
+        new_stop = hunk[-1][3] + (old_stop - hunk[-1][1])
+        lines = ['@@ -{} +{} @@\n'.format(
+            format_range(line + old_line, old_stop - old_line),
+            format_range(line + new_line, new_stop - new_line))]
+        for old_start, old_stop_change, new_start, new_stop_change in (
+                hunk + [(old_stop, old_stop, new_stop, new_stop)]):
+            for number in range(old_start - old_line):
+                old_offset = start + old_offsets[old_line + number]
+                new_offset = start + new_offsets[new_line + number]
+                old_text = format_diff_line(
+                    ' ', old, old_offset,
+                    start + old_offsets[old_line + number + 1])
+                new_text = format_diff_line(
+                    ' ', new, new_offset,
+                    start + new_offsets[new_line + number + 1])
+                # equal hashes of different lines are shown as changed
+                lines.append(old_text if old_text == new_text else
+                             '-' + old_text[1:] + '+' + new_text[1:])
+            lines += [format_diff_line('-', old, start + old_offsets[number],
+                                       start + old_offsets[number + 1])
+                      for number in range(old_start, old_stop_change)]
+            lines += [format_diff_line('+', new, start + new_offsets[number],
+                                       start + new_offsets[number + 1])
+                      for number in range(new_start, new_stop_change)]
+            old_line, new_line = old_stop_change, new_stop_change
+        yield ''.join(lines)
+
+
+def get_diff(repo, commits=(), cached=False):
+    """
+    Yield the unified diff (see get_diff_files) file by file and hunk by
+    hunk, so it can be written while it is computed.
+    """
+    worktree = not cached and len(commits) < 2
+    for path, old_sha, new_sha in get_diff_files(repo, commits, cached):
+        old = read_diff_content(repo, path, old_sha, False)
+        new = read_diff_content(repo, path, new_sha, worktree)
+        header = 'diff --lgit a/{0} b/{0}\n'.format(path)
+        if old_sha is None:
+            header += 'new file\n'
+        elif new_sha is None:
+            header += 'deleted file\n'
+        if (b'\0' in old[:DIFF_BINARY_CHECK] or
+                b'\0' in new[:DIFF_BINARY_CHECK]):
+            yield header + 'Binary files {} and {} differ\n'.format(
+                'a/' + path if old_sha else '/dev/null',
+                'b/' + path if new_sha else '/dev/null')
+            continue
+        yield header + '--- {}\n+++ {}\n'.format(
+            'a/' + path if old_sha else '/dev/null',
+            'b/' + path if new_sha else '/dev/null')
+        yield from diff_buffers(old, new)
+
+
+def lgit_diff(repo, commits=(), cached=False):
+    """Show the changes, written to the pager as they are found."""
+    if len(commits) > 2:
+        raise LgitError('fatal: too many revisions')
+    pager = open_pager()
+    output = pager.stdin if pager else sys.stdout
+    try:
+        for text in get_diff(repo, commits, cached):
+            output.write(text)
+            output.flush()
+    except BrokenPipeError:
+        pass
+    finally:
+        if pager:
+            try:
+                pager.stdin.close()
+            except BrokenPipeError:
+                pass
+            pager.wait()
+
+
+def clone_legacy_object(repo, sha, target):
+    """
+    Copy a loose object written uncompressed by the previous versions (its
+    content as it is) to the file descriptor target without reading it:
+    the blocks are shared with the object (reflink) if the filesystem
+    supports it, otherwise they are copied by the kernel.
+    Return False if the object is not such an object or was not copied.
+    """
+    try:
+        file = open(get_object_path(repo, sha), 'rb')
+    except FileNotFoundError:
+        return False
+    with file:
+        if read_loose_header(file)[2] is not None:
+            return False
+        try:
+            ioctl(target, FICLONE, file.fileno())
+            return True
+        except OSError:
+            pass
+        if copy_file_range is None:
+            return False
+        size, offset = fstat(file.fileno()).st_size, 0
+        try:
+            while offset < size:
+                copied = copy_file_range(file.fileno(), target,
+                                         size - offset, offset, offset)
+                if not copied:
+                    return False
+                offset += copied
+        except OSError:
+            return False
+    return True
+
+
+def write_worktree_file(repo, path, sha):
+    """
+    Write the content of a blob to a file of the working directory. The
+    old file is unlinked first, so the file written is a new one (a hard
+    link to the old file is not changed). The uncompressed objects are
+    cloned, the others are decompressed chunk by chunk.
+    Return the stat data of the new file.
+    """
+    full_path = repo.root + '/' + path
+    try:
+        makedirs(dirname(full_path), exist_ok=True)
+        try:
+            unlink(full_path)
+        except FileNotFoundError:
+            pass
+    except OSError as error:
+        # a file is in place of a parent or a directory in place of the file
+        raise LgitError('error: unable to create file {}: {}'.format(
+            path, error.strerror))
+    descriptor = open_descriptor(full_path, O_WRONLY | O_CREAT | O_EXCL,
+                                 0o666)
+    with open(descriptor, 'wb') as file:
+        if not clone_legacy_object(repo, sha, descriptor):
+            for chunk in read_object_chunks(repo, sha)[2]:
+                file.write(chunk)
+    return get_stat_data(full_path)
+
+
+def remove_worktree_file(repo, path):
+    """Remove a file of the working directory and its empty parents."""
+    try:
+        unlink(repo.root + '/' + path)
+    except FileNotFoundError:
+        pass
+    directory = dirname(path)
+    while directory:
+        try:
+            rmdir(repo.root + '/' + directory)
+        except OSError:
+            break
+        directory = dirname(directory)
+
+
+def switch_commit(repo, commit_id):
+    """
+    Check out a commit: HEAD is moved to it and the index and the working
+    directory are updated to its snapshot. Only the files which differ
+    between HEAD and the commit are written (or removed), and their stat
+    data is stored in the index at the same time, so the next status does
+    not hash them again. The other files, and the changes made to them,
+    are kept. Nothing is changed if a file to update has changes.
+    Return the paths updated in the working directory.
+    """
+    acquire_index_lock(repo)
+    index = get_index_dict(repo)
+    index_mtime = get_index_mtime(repo)
+    changes, conflicts = [], []
+    for path, old, new in diff_commits(repo, get_head(repo), commit_id):
+        entry = index.get(path)
+        staged = get_hex_digest(entry.staged_sha) if entry else None
+        worktree = get_worktree_file_sha1(repo, path, entry, index_mtime)
+        if staged == new and worktree == new:
+            if entry:
+                index[path] = entry._replace(commit_sha=get_raw_digest(new))
+        elif staged != old or worktree not in (old, new):
+            conflicts.append(path)
+        else:
+            changes.append((path, new))
+    if conflicts:
+        raise LgitError(
+            'error: Your local changes to the following files would be '
+            'overwritten by checkout:\n\t' + '\n\t'.join(conflicts) +
+            '\nPlease commit your changes before you check out a '
+            'commit.\nAborting')
+    # the files are removed first: a directory may replace a file
+    for path, new in reversed(changes):
+        if new is None:
+            remove_worktree_file(repo, path)
+            index.pop(path)
+            invalidate_cache_tree(repo, path)
+    for path, new in changes:
+        if new is not None:
+            stat_data = write_worktree_file(repo, path, new)
+            raw = bytes.fromhex(new)
+            index[path] = IndexEntry(*stat_data, raw, raw, raw)
+            invalidate_cache_tree(repo, path)
+    set_head(repo, commit_id)
+    update_index_file(repo, index)
+    return [path for path, _ in changes]
+
+
+def restore_files(repo, paths, commit_id=None, base=None):
+    """
+    Restore the files under paths (relative to the directory base, the
+    current directory by default) in the working directory from the index
+    or, if commit_id is given, from a commit (they are staged too). Only
+    the files whose content differs are written.
+    Return the paths restored in the working directory.
+    """
+    base = base or getcwd()
+    acquire_index_lock(repo)
+    index = get_index_dict(repo)
+    index_mtime = get_index_mtime(repo)
+    if commit_id is None:
+        source = {path: entry.staged_sha.hex()
+                  for path, entry in index.items()}
+    else:
+        source = get_commit_files(repo, commit_id)
+    files = set()
+    for path in paths:
+        key = get_path_key(repo, path, base)
+        matched = {file for file in source if key == '.' or file == key or
+                   file.startswith(key + '/')}
+        if not matched:
+            raise LgitError("error: pathspec '" + path + "' did not match "
+                            "any file(s) known to lgit")
+        files |= matched
+    restored = []
+    for path in sorted(files):
+        sha, entry = source[path], index.get(path)
+        if get_worktree_file_sha1(repo, path, entry, index_mtime) != sha:
+            stat_data = write_worktree_file(repo, path, sha)
+            restored.append(path)
+        else:
+            stat_data = get_stat_data(repo.root + '/' + path)
+        sha = bytes.fromhex(sha)
+        if entry is None or entry.staged_sha != sha:
+            invalidate_cache_tree(repo, path)
+        index[path] = create_info(stat_data, sha, entry)
+    update_index_file(repo, index)
+    return restored
+
+
+def parse_checkout_arguments(repo, arguments):
+    """
+    Split the arguments of lgit checkout into the commit (None for the
+    index) and the paths (None to check out the commit). The paths follow
+    '--' or, without it, the first argument if it names a commit.
+    """
+    if '--' in arguments:
+        position = arguments.index('--')
+        if position > 1:
+            raise LgitError('fatal: only one commit can be checked out')
+        if position == len(arguments) - 1:
+            raise LgitError('fatal: you must specify path(s) to restore')
+        return (resolve_commit(repo, arguments[0]) if position else None,
+                arguments[position + 1:])
+    if not arguments:
+        raise LgitError('fatal: you must specify a commit or path(s)')
+    try:
+        commit_id = resolve_commit(repo, arguments[0])
+    except LgitError:
+        return None, arguments
+    return commit_id, arguments[1:] or None
+
+
+def lgit_checkout(repo, arguments):
+    """Check out a commit, or restore files from the index or a commit."""
+    commit_id, paths = parse_checkout_arguments(repo, arguments)
+    if paths is None:
+        switch_commit(repo, commit_id)
+        print('HEAD is now at {} {}'.format(
+            commit_id, read_commit_message(repo, commit_id).split('\n')[0]))
+        return
+    restored = restore_files(repo, paths, commit_id)
+    print('Updated {} path{} from {}'.format(
+        len(restored), '' if len(restored) == 1 else 's',
+        commit_id or 'the index'))
+
+
+def get_snapshot_entries(repo, name):
+    """Yield (SHA1, path) of the files recorded in a flat snapshot."""
+    try:
+        with open(repo.snapshots + '/' + name, 'r') as file:
+            for line in file:
+                yield line[:40], line[41:-1]
+    except (PermissionError, FileNotFoundError):
+        pass
+
+
+def get_commit_entries(repo, commit_id, seen=None):
+    """
+    Yield (SHA1, path) of the objects of a commit snapshot: its trees and
+    files, or the files of a flat snapshot for the previous versions.
+    """
+    header = read_commit_header(repo, commit_id)
+    if header is None:
+        return
+    if 'tree' not in header:
+        yield from get_snapshot_entries(repo, header['snapshot'])
+    elif seen is None or header['tree'] not in seen:
+        if seen is not None:
+            seen.add(header['tree'])
+        yield header['tree'], ''
+        yield from get_tree_entries(repo, header['tree'], '', seen)
+
+
+def get_object_names(repo):
+    """
+    Map SHA1 of the objects to a path they were recorded with.
+    The trees shared by several commits are walked once.
+    """
+    names, seen = {}, set()
+    for commit_id in listdir(repo.commits):
+        names.update(get_commit_entries(repo, commit_id, seen))
+    for path, entry in get_index_dict(repo).items():
+        names[entry.staged_sha.hex()] = path
+    return names
+
+
+def get_loose_objects(repo):
+    """Yield SHA1 of the loose objects in objects directory."""
+    objects = repo.objects + '/'
+    for prefix in listdir(objects):
+        if len(prefix) == 2 and isdir(objects + prefix):
+            for rest in listdir(objects + prefix):
+                if len(rest) == 38:
+                    yield prefix + rest
+
+
+def write_pack_entry(file, obj_type, size, data, base=None):
+    """Write an object (or a delta against base) to the pack file."""
+    data = compress(data)
+    file.write(PACK_ENTRY.pack(base is not None, OBJECT_TYPES.index(obj_type),
+                               size, len(data)))
+    if base is not None:
+        file.write(bytes.fromhex(base))
+    file.write(data)
+
+
+def write_pack_stream(file, obj_type, size, chunks):
+    """Write a large object to the pack file without loading it."""
+    start = file.tell()
+    file.write(PACK_ENTRY.pack(0, OBJECT_TYPES.index(obj_type), size, 0))
+    compressor = compressobj()
+    for chunk in chunks:
+        file.write(compressor.compress(chunk))
+    file.write(compressor.flush())
+    end = file.tell()
+    file.seek(start)
+    file.write(PACK_ENTRY.pack(0, OBJECT_TYPES.index(obj_type), size,
+                               end - start - PACK_ENTRY.size))
+    file.seek(end)
+
+
+def find_delta_base(window, obj_type, data):
+    """
+    Find the object of the window giving the smallest delta for data.
+    Return (SHA1 of the base, delta, depth of the delta chain) or None.
+    """
+    best = None
+    for sha, base_type, base_data, blocks, depth in window:
+        if base_type != obj_type or depth >= DELTA_DEPTH:
+            continue
+        max_size = len(best[1]) if best else len(data) // 2
+        delta = create_delta(base_data, blocks, data, max_size)
+        if delta is not None:
+            best = (sha, delta, depth + 1)
+    return best
+
+
+def write_pack(repo, path, objects):
+    """
+    Write the objects to a pack file, each object either compressed as a
+    whole or as a delta against one of the previous DELTA_WINDOW objects.
+    Chunks of chunked blobs are already deduplicated and are not deltified.
+    Return the offsets of the objects and the number of deltas.
+    """
+    offsets, window, deltas = {}, [], 0
+    with open(path, 'wb') as file:
+        file.write(PACK_HEADER.pack(PACK_SIGNATURE, PACK_VERSION,
+                                    len(objects)))
+        for obj_type, _, _, size, sha in objects:
+            offsets[sha] = file.tell()
+            if size > DELTA_LIMIT or obj_type == 'chunk':
+                write_pack_stream(file, obj_type, size,
+                                  read_raw_object_chunks(repo, sha)[2])
+                continue
+            data = read_raw_object(repo, sha)[1]
+            best = find_delta_base(window, obj_type, data)
+            if best:
+                write_pack_entry(file, obj_type, size, best[1], best[0])
+                deltas += 1
+            else:
+                write_pack_entry(file, obj_type, size, data)
+            window.append((sha, obj_type, data, get_delta_blocks(data),
+                           best[2] if best else 0))
+            while (len(window) > DELTA_WINDOW or
+                   sum(len(item[2]) for item in window) >
+                   DELTA_WINDOW_MEMORY):
+                window.pop(0)
+    return offsets, deltas
+
+
+def write_pack_index(path, offsets):
+    """Write the index (fan-out table, SHA1s, offsets) of a pack file."""
+    shas = sorted(bytes.fromhex(sha) for sha in offsets)
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[sha[0]] += 1
+    for position in range(1, 256):
+        fanout[position] += fanout[position - 1]
+    data = b''.join(
+        [PACK_HEADER.pack(PACK_INDEX_SIGNATURE, PACK_VERSION, len(shas)),
+         PACK_FANOUT.pack(*fanout)] + shas +
+        [PACK_OFFSET.pack(offsets[sha.hex()]) for sha in shas])
+    with open(path, 'wb') as file:
+        file.write(data + sha1(data).digest())
+
+
+def pack_objects(repo, shas):
+    """
+    Write the objects to a new pack file with delta compression (sorted by
+    type, name and size so that similar objects are close) and its index.
+    Return the path of the pack (without extension) and the number of
+    deltas.
+    """
+    objects_dir = repo.objects + '/'
+    names = get_object_names(repo)
+    objects = []
+    for sha in shas:
+        obj_type, size, chunks = read_raw_object_chunks(repo, sha)
+        chunks.close()
+        name = names.get(sha, '')
+        objects.append((obj_type, name.rsplit('/', 1)[-1], name, size, sha))
+    objects.sort(key=lambda item: item[:3] + (-item[3], item[4]))
+    create_dir(objects_dir + 'pack')
+    from tempfile import mkstemp
+    descriptor, temp_path = mkstemp(dir=objects_dir + 'pack',
+                                    prefix='tmp_pack_')
+    close(descriptor)
+    offsets, deltas = write_pack(repo, temp_path, objects)
+    pack_sha = hash_sha1(temp_path)
+    with open(temp_path, 'ab') as file:
+        file.write(bytes.fromhex(pack_sha))
+    pack_path = objects_dir + 'pack/pack-' + pack_sha
+    write_pack_index(temp_path + '.idx', offsets)
+    replace(temp_path, pack_path + '.pack')
+    replace(temp_path + '.idx', pack_path + '.idx')
+    return pack_path, deltas
+
+
+def lgit_repack(repo):
+    """
+    Pack all objects (loose objects and existing packs) into a single pack
+    file with delta compression, then remove the packed loose objects and
+    the old packs.
+    """
+    objects_dir = repo.objects + '/'
+    old_packs = get_packs(repo)
+    loose = set(get_loose_objects(repo))
+    shas = set(loose)
+    for pack in old_packs:
+        shas.update(pack.get_shas())
+    if not shas:
+        print('Nothing to pack')
+        return
+    pack_path, deltas = pack_objects(repo, shas)
+    for pack in old_packs:
+        if pack.path != pack_path:
+            unlink(pack.path + '.idx')
+            unlink(pack.path + '.pack')
+    for sha in loose:
+        unlink(objects_dir + sha[:2] + '/' + sha[2:])
+    for prefix in {sha[:2] for sha in loose}:
+        try:
+            rmdir(objects_dir + prefix)
+        except OSError:
+            pass
+    repo.packs = None
+    print('Total {} (delta {})'.format(len(shas), deltas))
+
+
+def mark_tree(repo, sha, reachable):
+    """
+    Mark a tree and the objects under it as reachable. The trees already
+    marked (shared with another commit) are not read again.
+    """
+    raw = bytes.fromhex(sha)
+    if raw in reachable:
+        return
+    reachable.add(raw)
+    pending = [sha]
+    while pending:
+        for _, obj_type, entry_sha in read_tree(repo, pending.pop()):
+            raw = bytes.fromhex(entry_sha)
+            if raw not in reachable:
+                reachable.add(raw)
+                if obj_type == 'tree':
+                    pending.append(entry_sha)
+
+
+def mark_reachable_objects(repo):
+    """
+    Return the set of the objects reachable from the index and from all
+    the commits and snapshots, as raw 20-byte SHA1s (less than half the
+    memory of hexadecimal strings). The commits and the flat snapshots
+    are read one at a time, line by line.
+    """
+    reachable = set()
+    for entry in get_index_dict(repo).values():
+        reachable.update((entry.staged_sha, entry.commit_sha))
+    reachable.discard(NULL_SHA)
+    for _, sha in get_cache_tree(repo).values():
+        mark_tree(repo, sha, reachable)
+    for commit_id in listdir(repo.commits):
+        header = read_commit_header(repo, commit_id) or {}
+        if 'tree' in header:
+            mark_tree(repo, header['tree'], reachable)
+    for name in listdir(repo.snapshots):
+        for sha, _ in get_snapshot_entries(repo, name):
+            reachable.add(bytes.fromhex(sha))
+    return reachable
+
+
+def get_object_type(repo, sha):
+    """Return the type of an object as it is stored, None if it is lost."""
+    try:
+        obj_type, _, chunks = read_raw_object_chunks(repo, sha)
+    except FileNotFoundError:
+        return None
+    chunks.close()
+    return obj_type
+
+
+def mark_chunks(repo, reachable):
+    """
+    Mark the chunks of the reachable chunked blobs. The trees do not tell
+    the chunked blobs from the others, so the header of every reachable
+    object is read.
+    """
+    for raw in list(reachable):
+        if get_object_type(repo, raw.hex()) == 'chunked':
+            for line in read_raw_object(repo, raw.hex())[1].splitlines():
+                reachable.add(bytes.fromhex(line.split()[0].decode()))
+
+
+def mark_delta_bases(repo, reachable):
+    """
+    Mark the bases of the reachable objects stored as deltas in the packs
+    (recursively): a delta cannot be read without its base.
+    """
+    packs = get_packs(repo)
+    pending = []
+    for pack in packs:
+        for position in range(pack.count):
+            if pack.get_sha(position) in reachable:
+                pending.append(pack.get_delta_base(pack.get_offset(position)))
+    while pending:
+        base = pending.pop()
+        if base is None or base in reachable:
+            continue
+        reachable.add(base)
+        for pack in packs:
+            offset = pack.find(base.hex())
+            if offset is not None:
+                pending.append(pack.get_delta_base(offset))
+
+
+def get_unreachable_objects(repo, reachable, cutoff):
+    """
+    Return the unreachable loose objects and the packs holding unreachable
+    objects, last modified before cutoff (POSIX time).
+    """
+    loose = []
+    for sha in get_loose_objects(repo):
+        if bytes.fromhex(sha) not in reachable:
+            try:
+                if stat(get_object_path(repo, sha)).st_mtime < cutoff:
+                    loose.append(sha)
+            except FileNotFoundError:
+                pass
+    packs = [pack for pack in get_packs(repo)
+             if stat(pack.path + '.pack').st_mtime < cutoff and
+             any(pack.get_sha(position) not in reachable
+                 for position in range(pack.count))]
+    return loose, packs
+
+
+def remove_stale_files(directory, prefix, cutoff):
+    """Remove the temporary files left by interrupted lgit commands."""
+    try:
+        entries = list(scandir(directory))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if (entry.name.startswith(prefix) and entry.is_file() and
+                entry.stat().st_mtime < cutoff):
+            unlink(entry.path)
+
+
+def collect_garbage(repo, grace=GC_GRACE):
+    """
+    Remove the objects unreachable from the index, the commits and the
+    snapshots. The objects written less than grace seconds ago are kept:
+    they may belong to a command still running. The unreachable loose
+    objects are deleted and the packs holding unreachable objects are
+    written again without them.
+    Return the number of objects removed.
+    """
+    # the index lock keeps add, rm and commit out while the objects are
+    # marked and swept
+    acquire_index_lock(repo)
+    try:
+        cutoff = time() - grace
+        reachable = mark_reachable_objects(repo)
+        loose, packs = get_unreachable_objects(repo, reachable, cutoff)
+        if any(get_object_type(repo, sha) == 'chunk' for sha in chain(
+                loose, (pack.get_sha(position).hex() for pack in packs
+                        for position in range(pack.count)
+                        if pack.get_sha(position) not in reachable))):
+            mark_chunks(repo, reachable)
+        mark_delta_bases(repo, reachable)
+        loose, packs = get_unreachable_objects(repo, reachable, cutoff)
+        removed = len(loose)
+        if packs:
+            kept = set()
+            for pack in packs:
+                for position in range(pack.count):
+                    raw = pack.get_sha(position)
+                    if raw in reachable:
+                        kept.add(raw.hex())
+                    else:
+                        removed += 1
+            pack_path = pack_objects(repo, kept)[0] if kept else None
+            for pack in packs:
+                if pack.path != pack_path:
+                    unlink(pack.path + '.idx')
+                    unlink(pack.path + '.pack')
+            repo.packs = None
+        for sha in loose:
+            unlink(get_object_path(repo, sha))
+        for prefix in {sha[:2] for sha in loose}:
+            try:
+                rmdir(repo.objects + '/' + prefix)
+            except OSError:
+                pass
+        if removed:
+            # the object-ids files list deleted objects: the next add
+            # writes them again
+            for path in (repo.object_ids_path, repo.object_ids_log_path):
+                try:
+                    unlink(path)
+                except FileNotFoundError:
+                    pass
+            repo.object_ids = None
+        for directory, prefix in ((repo.objects, 'tmp_obj_'),
+                                  (repo.objects + '/pack', 'tmp_pack_'),
+                                  (repo.lgit, 'tmp_')):
+            remove_stale_files(directory, prefix, cutoff)
+    finally:
+        unlock_index(repo)
+    return removed
+
+
+def lgit_gc(repo, grace=GC_GRACE):
+    """Remove the unreachable objects older than grace seconds."""
+    removed = collect_garbage(repo, grace)
+    print('Removed {} unreachable object{}'.format(
+        removed, '' if removed == 1 else 's'))
+
+
+def send_fsmonitor_request(repo, request):
+    """
+    Send a request to the fsmonitor daemon of the repository.
+    Return its answer, or None if the daemon is not running.
+    """
+    return send_socket_request(repo.lgit + '/fsmonitor.sock', request)
+
+
+def send_socket_request(path, request):
+    """
+    Send a JSON request to the daemon listening on a Unix socket.
+    Return its answer, or None if the daemon is not running.
+    """
+    if not exists(path):
+        return None
+    from socket import socket, AF_UNIX, SOCK_STREAM, SHUT_WR
+    try:
+        with socket(AF_UNIX, SOCK_STREAM) as client:
+            client.settimeout(FSMONITOR_TIMEOUT)
+            client.connect(path)
+            client.sendall(dumps(request).encode() + b'\n')
+            client.shutdown(SHUT_WR)
+            data = b''.join(iter(lambda: client.recv(CHUNK_SIZE), b''))
+        return loads(data)
+    except (OSError, ValueError):
+        return None
+
+
+def get_fsmonitor_changes(repo):
+    """
+    Ask the fsmonitor daemon (once per command) for the paths changed
+    since the token saved in the index. A path ending with '/' means the
+    whole directory changed.
+    Return the set of changed paths, or None if everything must be
+    examined (no daemon, no valid token or an overflow of the daemon).
+    """
+    if not repo.fsmonitor_queried:
+        repo.fsmonitor_queried = True
+        token = get_index_extensions(repo).get(FSMONITOR_EXTENSION, b'')
+        answer = send_fsmonitor_request(
+            repo, {'command': 'query', 'token': token.decode()})
+        if answer:
+            repo.fsmonitor_token = answer['token']
+            if not answer['full']:
+                repo.fsmonitor_changes = set(answer['paths'])
+                if '.lgitignore' in repo.fsmonitor_changes:
+                    repo.fsmonitor_changes = None
+    return repo.fsmonitor_changes
+
+
+def save_fsmonitor_token(repo):
+    """Save the token of the fsmonitor daemon in the index."""
+    if repo.fsmonitor_token:
+        token = repo.fsmonitor_token.encode()
+        extensions = get_index_extensions(repo)
+        if extensions.get(FSMONITOR_EXTENSION) != token:
+            extensions[FSMONITOR_EXTENSION] = token
+            repo.index_changed = True
+
+
+def is_path_changed(path, entry, changes):
+    """
+    Check if an index entry must be examined: the fsmonitor daemon is not
+    used, it reported the path (or a parent directory) changed, or the
+    entry has no valid stat data.
+    """
+    if changes is None or not entry.mtime or path in changes:
+        return True
+    position = path.find('/')
+    while position != -1:
+        if path[:position + 1] in changes:
+            return True
+        position = path.find('/', position + 1)
+    return False
+
+
+class FSMonitor:
+    """
+    The file system monitor daemon: watch the working directory with
+    Linux inotify and answer the paths changed since a token on a Unix
+    socket. A token is '<daemon id>:<sequence number of the last change>'.
+    """
+
+    def __init__(self, repo):
+        from ctypes import CDLL, get_errno
+        from ctypes.util import find_library
+        self.repo = repo
+        self.libc = CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), 'inotify_init1 failed')
+        self.id = '{}.{}'.format(getpid(), time_ns())
+        self.watches, self.changes = {}, {}
+        self.sequence = self.full_scan = 0
+        self.running = True
+        self.add_watches(repo.root)
+
+    def add_watches(self, path, report=False):
+        """
+        Watch a directory and its sub-directories (pruned like the walk
+        of the working directory). Report their files changed if the
+        directory was created or moved after the daemon started.
+        """
+        for directory, prefix, files in walk_tree(self.repo, path):
+            watch = self.libc.inotify_add_watch(
+                self.fd, fsencode(directory), FSMONITOR_MASK)
+            if watch >= 0:
+                self.watches[watch] = prefix
+            if report:
+                for entry in files:
+                    self.mark_changed(prefix + entry.name)
+
+    def mark_changed(self, key):
+        self.sequence += 1
+        self.changes[key] = self.sequence
+
+    def read_events(self):
+        """Read the pending inotify events and record the changes."""
+        while True:
+            try:
+                data = read(self.fd, FSMONITOR_BUFFER)
+            except BlockingIOError:
+                return
+            position = 0
+            while position < len(data):
+                watch, mask, _, length = INOTIFY_EVENT.unpack_from(
+                    data, position)
+                position += INOTIFY_EVENT.size
+                name = fsdecode(data[position:position + length]
+                                .rstrip(b'\0'))
+                position += length
+                self.handle_event(watch, mask, name)
+
+    def handle_event(self, watch, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost: every token given so far is invalid.
+            self.sequence += 1
+            self.full_scan = self.sequence
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(watch, None)
+            return
+        if watch not in self.watches or not name:
+            return
+        key = self.watches[watch] + name
+        if not mask & IN_ISDIR:
+            if key == '.lgitignore':
+                self.repo.ignore = None
+                self.add_watches(self.repo.root)
+            self.mark_changed(key)
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+            ignore_dir = get_ignore_matchers(self.repo)[1]
+            if name != '.lgit' and not (ignore_dir and ignore_dir(key)):
+                self.add_watches(self.repo.root + '/' + key, True)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.mark_changed(key + '/')
+
+    def answer(self, request):
+        """Answer a request of a client."""
+        if request.get('command') == 'stop':
+            self.running = False
+            return {}
+        self.read_events()
+        token = '{}:{}'.format(self.id, self.sequence)
+        daemon_id, _, sequence = request.get('token', '').partition(':')
+        if (daemon_id != self.id or not sequence.isdigit() or
+                int(sequence) < self.full_scan):
+            return {'token': token, 'full': True, 'paths': []}
+        sequence = int(sequence)
+        return {'token': token, 'full': False,
+                'paths': [key for key, number in self.changes.items()
+                          if number > sequence]}
+
+    def accept(self, server):
+        client = server.accept()[0]
+        with client:
+            client.settimeout(FSMONITOR_TIMEOUT)
+            try:
+                data = b''
+                while not data.endswith(b'\n'):
+                    chunk = client.recv(CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    data += chunk
+                client.sendall(dumps(self.answer(loads(data))).encode())
+            except (OSError, ValueError):
+                pass
+
+    def serve(self, path):
+        """Answer the clients on the Unix socket until asked to stop."""
+        from socket import socket, AF_UNIX, SOCK_STREAM
+        from selectors import DefaultSelector, EVENT_READ
+        with socket(AF_UNIX, SOCK_STREAM) as server:
+            server.bind(path)
+            server.listen(16)
+            selector = DefaultSelector()
+            selector.register(self.fd, EVENT_READ)
+            selector.register(server, EVENT_READ)
+            try:
+                while self.running:
+                    for key, _ in selector.select():
+                        if key.fileobj is server:
+                            self.accept(server)
+                        else:
+                            self.read_events()
+            finally:
+                selector.close()
+                close(self.fd)
+                if exists(path):
+                    unlink(path)
+
+
+def start_daemon(path, serve):
+    """
+    Run serve(path) in a daemon process (double fork) and wait until it
+    answers on the Unix socket. Return True if the daemon is started.
+    """
+    if exists(path):
+        unlink(path)
+    pid = fork()
+    if pid:
+        waitpid(pid, 0)
+        for _ in range(DAEMON_START_TRIES):
+            if send_socket_request(path, {'command': 'query'}):
+                return True
+            sleep(0.05)
+        return False
+    setsid()
+    if fork():
+        _exit(0)
+    null = open(devnull, 'r+')
+    for stream in (0, 1, 2):
+        dup2(null.fileno(), stream)
+    signal(SIGTERM, lambda *_: exit())
+    try:
+        serve(path)
+    finally:
+        _exit(0)
+
+
+def start_fsmonitor(repo):
+    """Start the fsmonitor daemon in the background."""
+    from ctypes import CDLL
+    from ctypes.util import find_library
+    if not find_library('c') or not hasattr(
+            CDLL(find_library('c')), 'inotify_init1'):
+        raise LgitError('fatal: fsmonitor requires Linux inotify')
+    if not start_daemon(repo.lgit + '/fsmonitor.sock',
+                        FSMonitor(repo).serve):
+        raise LgitError('fatal: could not start fsmonitor')
+    print('fsmonitor started')
+
+
+def lgit_fsmonitor(repo, action):
+    """Start, stop or check the fsmonitor daemon of the repository."""
+    running = send_fsmonitor_request(repo, {'command': 'query'})
+    if action == 'status':
+        print('fsmonitor is ' + ('running' if running else 'not running'))
+    elif action == 'stop':
+        if running:
+            send_fsmonitor_request(repo, {'command': 'stop'})
+            print('fsmonitor stopped')
+        else:
+            print('fsmonitor is not running')
+    elif running:
+        print('fsmonitor is already running')
+    else:
+        start_fsmonitor(repo)
+
+
+class CommandServer:
+    """
+    The lgit server of a repository: it runs the lgit commands sent on a
+    Unix socket in one process, keeping the repository, its parsed index
+    (and stat cache), pack files and ignore patterns loaded between them.
+    A request is a JSON line {"args": [command and arguments], "cwd": dir}
+    and is answered by a JSON line {"output": text, "code": exit status};
+    a client can send several requests on the same connection.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.state = {}
+        self.running = True
+
+    def refresh(self):
+        """
+        Drop the caches whose files were changed on disk by another
+        process since the previous request, and the per-command state.
+        """
+        repo = self.repo
+        for path, attributes in (
+                (repo.index_path, ('index', 'index_extensions',
+                                   'mapped_index', 'cache_tree')),
+                (repo.objects + '/pack', ('packs',)),
+                (repo.object_ids_path, ('object_ids',)),
+                (repo.object_ids_log_path, ('object_ids',)),
+                (repo.root + '/.lgitignore', ('ignore',))):
+            state = get_path_state(path)
+            if path not in self.state or self.state[path] != state:
+                self.state[path] = state
+                for attribute in attributes:
+                    setattr(repo, attribute, None)
+        repo.index_changed = False
+        repo.fsmonitor_queried = False
+        repo.fsmonitor_token = None
+        repo.fsmonitor_changes = None
+
+    def run(self, argv, cwd):
+        """Run a command, return its output and its exit status."""
+        self.refresh()
+        output, code = StringIO(), 0
+        try:
+            chdir(cwd)
+            with redirect_stdout(output), redirect_stderr(output):
+                args = parse_arguments(argv)
+                if args.command in ('init', 'serve'):
+                    print('fatal: ' + args.command + ' cannot be served')
+                    code = 1
+                else:
+                    run_command(self.repo, args)
+        except SystemExit as error:
+            # the command stopped halfway: its caches may be out of date
+            self.repo, self.state = Repository(self.repo.root), {}
+            code = error.code if isinstance(error.code, int) else 0
+        except Exception as error:
+            self.repo, self.state = Repository(self.repo.root), {}
+            output.write(str(error) + '\n')
+            code = 1
+        # the changes made by the command itself are already cached
+        for path in self.state:
+            self.state[path] = get_path_state(path)
+        return output.getvalue(), code
+
+    def answer(self, request):
+        if request.get('command') == 'stop':
+            self.running = False
+            return {'stopped': True}
+        if request.get('command') == 'query':
+            return {'pid': getpid()}
+        output, code = self.run([str(arg) for arg in request['args']],
+                                request.get('cwd', self.repo.root))
+        return {'output': output, 'code': code}
+
+    def accept(self, server, selector):
+        from selectors import EVENT_READ
+        client = server.accept()[0]
+        # a client not reading its answers is dropped instead of blocking
+        # the others
+        client.settimeout(FSMONITOR_TIMEOUT)
+        selector.register(client, EVENT_READ, [b''])
+
+    def read_requests(self, key, selector):
+        """
+        Answer the complete requests received from a client, or close its
+        connection at its end or on an invalid request.
+        """
+        client, pending = key.fileobj, key.data
+        try:
+            chunk = client.recv(CHUNK_SIZE)
+            *lines, pending[0] = (pending[0] + chunk).split(b'\n')
+            for line in lines:
+                client.sendall(dumps(self.answer(loads(line))).encode() +
+                               b'\n')
+                if not self.running:
+                    break
+            if chunk and self.running:
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        selector.unregister(client)
+        client.close()
+
+    def serve(self, path):
+        """
+        Answer the clients on the Unix socket until asked to stop. The
+        connections are multiplexed: a request is answered as soon as it
+        is received, whatever the other clients do.
+        """
+        from socket import socket, AF_UNIX, SOCK_STREAM
+        from selectors import DefaultSelector, EVENT_READ
+        with socket(AF_UNIX, SOCK_STREAM) as server:
+            server.bind(path)
+            server.listen(16)
+            selector = DefaultSelector()
+            selector.register(server, EVENT_READ)
+            try:
+                while self.running:
+                    for key, _ in selector.select():
+                        if key.fileobj is server:
+                            self.accept(server, selector)
+                        else:
+                            self.read_requests(key, selector)
+            finally:
+                for key in list(selector.get_map().values()):
+                    if key.fileobj is not server:
+                        key.fileobj.close()
+                selector.close()
+                if exists(path):
+                    unlink(path)
+
+
+def lgit_serve(repo, action):
+    """Start, stop or check the lgit server of the repository."""
+    path = repo.lgit + '/serve.sock'
+    running = send_socket_request(path, {'command': 'query'})
+    if action == 'status':
+        print('server is ' + ('running' if running else 'not running'))
+    elif action == 'stop':
+        if running:
+            send_socket_request(path, {'command': 'stop'})
+            print('server stopped')
+        else:
+            print('server is not running')
+    elif running:
+        print('server is already running')
+    elif start_daemon(path, CommandServer(repo).serve):
+        print('server started')
+    else:
+        raise LgitError('fatal: could not start the server')
+
+
+# the phases of the commands traced as nested spans
+TRACE_SPANS = (
+    'run_command', 'lgit_add', 'lgit_remove', 'lgit_commit', 'lgit_status',
+    'lgit_log', 'lgit_ls_files', 'lgit_diff', 'lgit_repack',
+    'get_index_dict', 'update_index_file', 'get_mapped_index',
+    'get_fsmonitor_changes', 'get_all_files', 'get_file_paths',
+    'get_changed_file_paths', 'store_files', 'get_status_paths_list',
+    'get_untracked_files', 'create_snap_file', 'write_index_tree',
+    'get_commit_graph', 'get_object_names', 'write_pack',
+    'get_worktree_files', 'get_commit_files', 'lgit_checkout',
+    'switch_commit', 'restore_files', 'lgit_gc',
+    'mark_reachable_objects', 'mark_chunks', 'mark_delta_bases',
+    'get_unreachable_objects', 'pack_objects', 'update_object_ids')
+# the functions called per file or per object: only their number of calls
+# and total time are recorded, with the counters they increment
+TRACE_COUNTERS = {
+    'get_stat_data': {'files_stated': lambda args, result: 1},
+    'hash_sha1': {'files_hashed': lambda args, result: 1,
+                  'bytes_hashed': lambda args, result:
+                  getsize(args[0]) if result else 0},
+    'get_worktree_sha1': {},
+    'is_walked_file': {},
+    'add_file': {},
+    'write_object_stream': {},
+    'store_object_file': {'objects_written': lambda args, result: 1,
+                          'bytes_hashed': lambda args, result: args[3]},
+    'read_raw_object_chunks': {'objects_read': lambda args, result: 1},
+    'write_worktree_file': {'files_written': lambda args, result: 1}}
+
+
+class Tracer:
+    """
+    Record the spans of the traced functions (start and duration, nested)
+    and the calls, time and counters of the functions called per file.
+    Tracing replaces the functions of the module by timed wrappers, so a
+    command run without --trace runs the functions as they are.
+    """
+
+    def __init__(self):
+        self.start = perf_counter_ns()
+        self.root = {'name': 'lgit', 'start': 0, 'children': []}
+        self.stack = [self.root]
+        self.spans = []
+        self.calls = {}
+        self.counters = {}
+
+    def install(self, namespace):
+        """Wrap the traced functions of a module namespace."""
+        for name in TRACE_SPANS:
+            namespace[name] = self.trace_span(name, namespace[name])
+        for name, counters in TRACE_COUNTERS.items():
+            namespace[name] = self.trace_calls(name, namespace[name],
+                                               counters)
+
+    def add_call(self, name, duration):
+        calls = self.calls.setdefault(name, [0, 0])
+        calls[0] += 1
+        calls[1] += duration
+
+    def trace_span(self, name, function):
+        def traced(*args, **kwargs):
+            span = {'name': name,
+                    'start': perf_counter_ns() - self.start, 'children': []}
+            self.stack[-1]['children'].append(span)
+            self.stack.append(span)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stack.pop()
+                span['duration'] = (perf_counter_ns() - self.start -
+                                    span['start'])
+                self.spans.append(span)
+                self.add_call(name, span['duration'])
+        return traced
+
+    def trace_calls(self, name, function, counters):
+        def traced(*args, **kwargs):
+            start = perf_counter_ns()
+            result = function(*args, **kwargs)
+            self.add_call(name, perf_counter_ns() - start)
+            for counter, measure in counters.items():
+                self.counters[counter] = (self.counters.get(counter, 0) +
+                                          measure(args, result))
+            return result
+        return traced
+
+    def get_json(self):
+        """Return the trace: nested spans, calls and counters (in ms)."""
+        def convert(span):
+            return {'name': span['name'],
+                    'start_ms': span['start'] / 1e6,
+                    'duration_ms': span['duration'] / 1e6,
+                    'children': [convert(child)
+                                 for child in span['children']]}
+        self.root['duration'] = perf_counter_ns() - self.start
+        return {'spans': convert(self.root),
+                'calls': {name: {'count': count, 'total_ms': total / 1e6}
+                          for name, (count, total) in
+                          sorted(self.calls.items())},
+                'counters': dict(sorted(self.counters.items()))}
+
+    def get_chrome_trace(self):
+        """Return the trace in the Chrome trace event format."""
+        self.root['duration'] = perf_counter_ns() - self.start
+        pid = getpid()
+        events = [{'name': span['name'], 'ph': 'X', 'pid': pid, 'tid': pid,
+                   'ts': span['start'] / 1e3, 'dur': span['duration'] / 1e3}
+                  for span in [self.root] + self.spans]
+        events.append({'name': 'counters', 'ph': 'C', 'pid': pid,
+                       'tid': pid, 'ts': self.root['duration'] / 1e3,
+                       'args': self.counters})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path, trace_format):
+        trace = (self.get_chrome_trace() if trace_format == 'chrome' else
+                 self.get_json())
+        with open(path, 'w') as file:
+            file.write(dumps(trace, indent=1) + '\n')
+
+
+def run_command(repo, args):
+    """Run a lgit command (other than init) in the repository."""
+    with releasing_index_lock(repo):
+        if args.command == 'add':
+            lgit_add(repo, args.files, args.jobs or cpu_count())
+        elif args.command == 'rm':
+            lgit_remove(repo, args.files)
+        elif args.command == 'config':
+            lgit_config(repo, args.author)
+        elif args.command == 'commit':
+            lgit_commit(repo, args.message)
+        elif args.command == 'status':
+            lgit_status(repo)
+        elif args.command == 'log':
+            lgit_log(repo, args.count, args.since, args.until, args.author)
+        elif args.command == 'ls-files':
+            lgit_ls_files(repo)
+        elif args.command == 'diff':
+            lgit_diff(repo, args.commits, args.cached)
+        elif args.command == 'checkout':
+            lgit_checkout(repo, args.arguments)
+        elif args.command == 'repack':
+            lgit_repack(repo)
+        elif args.command == 'gc':
+            lgit_gc(repo, args.grace)
+        elif args.command == 'fsmonitor':
+            lgit_fsmonitor(repo, args.action)
+        elif args.command == 'serve':
+            lgit_serve(repo, args.action)
+
+
+def main():
+    args = parse_arguments()
+    if args.command == 'init':
+        lgit_init()
+        return
+    repo = Repository.discover()
+    if not repo:
+        print_repo_exist_error()
+        sys.exit(1)
+    if not args.trace:
+        run_command(repo, args)
+        return
+    tracer = Tracer()
+    tracer.install(globals())
+    try:
+        run_command(repo, args)
+    finally:
+        tracer.write(args.trace, args.trace_format)
+
+
+def launch():
+    """
+    Run the command line, printing the error of a failed command, which
+    exits with status 1.
+    """
+    try:
+        main()
+    except Exception as error:
+        print(error)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    launch()